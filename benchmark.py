@@ -0,0 +1,225 @@
+#!/usr/bin/env python2
+'''Benchmarks for logfile_exporter
+
+Run `python benchmark.py --help` to see the available scenarios.
+'''
+
+# Python
+from collections import namedtuple
+from os.path import join
+import argparse
+import gc
+import logging
+import os
+import resource
+import select
+import shutil
+import tempfile
+import time
+import timeit
+
+# 3rd party
+import inotify
+import inotify.watcher
+
+# Local
+from logfile_exporter import AbstractLineHandler
+from logfile_exporter import CloudedEvent
+from logfile_exporter import MyWatcher
+from logfile_exporter import OPEN_THREADS
+from logfile_exporter import TimestampParser
+
+
+RawEvent = namedtuple('RawEvent', ['wd', 'mask', 'cookie', 'name'])
+
+
+class NoopLineHandler(AbstractLineHandler):
+
+    testcases = False
+
+    def process(self, line):
+        pass
+
+
+def legacy_process_events(watcher, raw_events):
+    '''How MyWatcher.process_events used to dispatch events'''
+    events = [inotify.watcher.Event(raw, watcher._wds[raw.wd][0]) for raw in raw_events]
+    for event in [CloudedEvent(event.raw, event.path) for event in events]:
+        for event_type in watcher._event_props:
+            if getattr(event, event_type):
+                try:
+                    handler = getattr(watcher, 'process_' + event_type)
+                except AttributeError:
+                    pass
+                else:
+                    handler(event)
+
+
+def current_process_events(watcher, raw_events):
+    '''MyWatcher.process_events, with the raw events instead of the inotify file descriptor'''
+    def read(_bufsize=None):
+        # MyWatcher.read, minus inotify.read
+        return [CloudedEvent(raw, watcher._wds[raw.wd][0]) for raw in raw_events]
+
+    watcher.read = read
+    try:
+        watcher.process_events()
+    finally:
+        del watcher.read
+
+
+def benchmark_dispatch(args):
+    '''Dispatching events for untracked files, so the dispatching itself dominates'''
+    folder = tempfile.mkdtemp()
+    try:
+        watcher = MyWatcher()
+        watcher.add_handler(join(folder, 'syslog'), NoopLineHandler())
+        wd = watcher.path(folder)[0]
+
+        masks = [inotify.IN_MODIFY, inotify.IN_CREATE, inotify.IN_MOVED_TO, inotify.IN_ACCESS]
+        raw_events = [RawEvent(wd, masks[index % len(masks)], 0, 'untracked') for index in range(args.events)]
+
+        for (name, func) in [('legacy', legacy_process_events), ('current', current_process_events)]:
+            seconds = min(timeit.repeat(lambda: func(watcher, raw_events), number=1, repeat=args.repeat))
+            print('dispatch {:8}: {:8.1f} ms for {} events, {:6.2f} us/event'.format(
+                name, seconds * 1000, args.events, seconds * 1e6 / args.events))
+    finally:
+        shutil.rmtree(folder)
+
+
+def benchmark_inotify(args):
+    '''Writing lines to a tracked file and processing the resulting events'''
+    folder = tempfile.mkdtemp()
+    try:
+        syslog = join(folder, 'syslog')
+        watcher = MyWatcher()
+        watcher.add_handler(syslog, NoopLineHandler())
+        poller = select.poll()
+        poller.register(watcher, select.POLLIN)
+
+        def run():
+            with open(syslog, 'a', 0) as handle:
+                for index in range(args.events):
+                    handle.write('12:34 Entry {}\n'.format(index))
+            while poller.poll(0):
+                watcher.process_events()
+
+        seconds = min(timeit.repeat(run, number=1, repeat=args.repeat))
+        print('inotify: {:8.1f} ms for {} writes, {:6.2f} us/write'.format(
+            seconds * 1000, args.events, seconds * 1e6 / args.events))
+    finally:
+        shutil.rmtree(folder)
+
+
+def benchmark_timestamps(args):
+    '''Parsing syslog timestamps with strptime compared to TimestampParser'''
+    start = time.time() - args.events
+    lines = [time.strftime('%b %d %H:%M:%S myhost app: entry', time.localtime(start + index // 100)) for index in range(args.events)]
+
+    def strptime():
+        year = time.localtime().tm_year
+        for line in lines:
+            time.mktime(time.strptime('{} {}'.format(year, line[:15]), '%Y %b %d %H:%M:%S'))
+
+    def cached():
+        parser = TimestampParser()
+        for line in lines:
+            parser.parse(line)
+
+    for (name, func) in [('strptime', strptime), ('cached', cached)]:
+        seconds = min(timeit.repeat(func, number=1, repeat=args.repeat))
+        print('timestamps {:8}: {:8.1f} ms for {} lines, {:6.2f} us/line'.format(
+            name, seconds * 1000, args.events, seconds * 1e6 / args.events))
+
+
+def rss():
+    '''Return the resident memory of this process in bytes'''
+    with open('/proc/self/statm') as handle:
+        return int(handle.read().split()[1]) * resource.getpagesize()
+
+
+def benchmark_startup(args):
+    '''Registering --files files spread over directories, one at a time and batched'''
+    (_soft, hard) = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard != resource.RLIM_INFINITY and hard < args.files + 100:
+        print('startup: skipped, only {} file descriptors allowed'.format(hard))
+        return
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    folder = tempfile.mkdtemp()
+    try:
+        logfiles = []
+        for index in range(args.files):
+            directory = join(folder, 'dir{}'.format(index % args.directories))
+            if not os.path.isdir(directory):
+                os.mkdir(directory)
+            path = join(directory, 'file{}.log'.format(index))
+            with open(path, 'w') as handle:
+                handle.write('12:34 Existing entry\n')
+            logfiles.append((path, NoopLineHandler()))
+
+        def one_at_a_time(watcher):
+            for (path, handler) in logfiles:
+                watcher.add_handler(path, handler)
+
+        def batched(watcher):
+            watcher.add_handlers(logfiles, threads=args.threads)
+
+        def measure(func):
+            # In a child process, so every variant starts with the same memory
+            (read_end, write_end) = os.pipe()
+            pid = os.fork()
+            if not pid:
+                os.close(read_end)
+                gc.collect()
+                before = rss()
+                watcher = MyWatcher()
+                start = timeit.default_timer()
+                func(watcher)
+                seconds = timeit.default_timer() - start
+                os.write(write_end, '{} {}'.format(seconds, rss() - before))
+                os._exit(0)
+            os.close(write_end)
+            with os.fdopen(read_end) as handle:
+                (seconds, memory) = handle.read().split()
+            os.waitpid(pid, 0)
+            return (float(seconds), int(memory))
+
+        for (name, func) in [('one at a time', one_at_a_time), ('batched', batched)]:
+            results = [measure(func) for _attempt in range(args.repeat)]
+            seconds = min(seconds for (seconds, _memory) in results)
+            memory = min(memory for (_seconds, memory) in results)
+            print('startup {:13}: {:8.1f} ms for {} files, {:6.1f} us/file, {:5.2f} KiB/file'.format(
+                name, seconds * 1000, args.files, seconds * 1e6 / args.files, memory / 1024.0 / args.files))
+    finally:
+        shutil.rmtree(folder)
+
+
+SCENARIOS = {
+    'dispatch': benchmark_dispatch,
+    'inotify': benchmark_inotify,
+    'startup': benchmark_startup,
+    'timestamps': benchmark_timestamps,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('scenarios', nargs='*', metavar='scenario', help='One of: {} (default: all)'.format(', '.join(sorted(SCENARIOS))))
+    parser.add_argument('--events', default=100000, type=int)
+    parser.add_argument('--repeat', default=3, type=int)
+    parser.add_argument('--files', default=5000, type=int, help='Number of files for the startup scenario')
+    parser.add_argument('--directories', default=50, type=int, help='Number of directories for the startup scenario')
+    parser.add_argument('--threads', default=OPEN_THREADS, type=int, help='Number of threads opening files in the startup scenario')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    for scenario in args.scenarios or sorted(SCENARIOS):
+        if scenario not in SCENARIOS:
+            parser.error('Unknown scenario {}'.format(scenario))
+        SCENARIOS[scenario](args)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,22 +2,46 @@
 
 # Python
 from BaseHTTPServer import HTTPServer
+from SocketServer import ThreadingMixIn
+from multiprocessing.pool import ThreadPool
 import abc
 import argparse
+import array
+import bisect
+import calendar
 import codecs
+import collections
+import datetime
+import errno
+import hashlib
+import httplib
+import inspect
+import json
 import logging
+import math
+import multiprocessing
 import os
+import re
 import select
+import signal
 import socket
 import sys
+import threading
+import time
+import urlparse
 
 # 3rd party
 from inotify.watcher import Watcher
+from prometheus_client import CONTENT_TYPE_LATEST
 from prometheus_client import Counter
+from prometheus_client import Gauge
+from prometheus_client import Histogram
 from prometheus_client import MetricsHandler
+from prometheus_client import REGISTRY
+from prometheus_client import Summary
+from prometheus_client import generate_latest
 import inotify
 
-# TODO: Implement offline mode
 # TODO: Support other inotify modules?
 # TODO: Support Python3 (using inotifyx?)
 
@@ -25,6 +49,8 @@ logger = logging.getLogger(__name__)
 
 
 POLL_TIMEOUT = 10000
+OPEN_THREADS = 1
+MAX_PROFILE_SECONDS = 300
 FILE_EVENTS_TO_WATCH = inotify.IN_MODIFY
 DIR_EVENTS_TO_WATCH = inotify.IN_MOVED_TO | inotify.IN_MOVED_FROM | inotify.IN_DELETE | inotify.IN_CREATE
 
@@ -52,10 +78,55 @@ class AbstractLineHandler(object):
     testcase_args = None  # Used to instantiate this class for a testcase
     testcase_kwargs = None  # Used to instantiate this class for a testcase
 
+    sample_every = 1  # Only process 1 in N lines; scale your metrics with sample_weight
+    order_independent = False  # True if parts of a file can be processed separately, see run_offline
+
     @abc.abstractmethod
     def process(self, line):
         pass
 
+    def process_lines(self, lines):
+        '''Process a batch of lines
+
+        Override this if your handler can do part of its work once per batch
+        instead of once per line.'''
+        for line in lines:
+            try:
+                self.process(line)
+            except Exception:
+                # Catching all possible exceptions: Continued service is
+                # more important than the processing of a particular line
+                self.logger.exception('Failed to process line %s', repr(line))
+
+    def reload_from(self, old_handler):
+        '''Take over the state of the handler this one replaces during a reload
+
+        Only called with handlers of the same type. Metrics defined on class
+        level keep their values without any help.'''
+        pass
+
+    @property
+    def sample_weight(self):
+        '''The number of lines every processed line represents
+
+        Increase your counters with this value to get estimated totals when
+        sampling is enabled.'''
+        return self.sample_every
+
+    def sample(self, lines):
+        '''Select the lines that should be processed
+
+        Every sample_every-th line is selected. The position within the
+        sampling interval is remembered between calls, so the selection is
+        independent of how the lines are split into batches.'''
+        if self.sample_every <= 1:
+            return lines
+
+        skip = getattr(self, '_sample_skip', 0)
+        sampled = lines[skip::self.sample_every]
+        self._sample_skip = (skip - len(lines)) % self.sample_every
+        return sampled
+
     @property
     def logger(self):
         try:
@@ -64,16 +135,454 @@ class AbstractLineHandler(object):
             self._logger = logging.getLogger(__name__ + '.' + self.__class__.__name__)
             return self._logger
 
+    @property
+    def timestamp_parser(self):
+        try:
+            return self._timestamp_parser
+        except AttributeError:
+            self._timestamp_parser = TimestampParser()
+            return self._timestamp_parser
+
+    def parse_timestamp(self, line):
+        '''Return the time found in a line as a unix timestamp, or None'''
+        return self.timestamp_parser.parse(line)
+
+
+# Not calendar.month_abbr, that depends on the locale
+MONTHS = dict((name, number) for (number, name) in enumerate(('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'), start=1))
+
+
+class TimestampParser(object):
+    '''Find and parse the time in log lines
+
+    Recognises the timestamps of syslog (Oct 18 12:34:56), ISO 8601
+    (2026-10-18T12:34:56.789+02:00, also with a space instead of the T) and
+    the common log format ([18/Oct/2026:12:34:56 +0000]). Timestamps without
+    a timezone are in local time; syslog timestamps are assumed to be from
+    the last 12 months.
+
+    The timestamp that starts earliest in the line wins, so a date in the
+    message doesn't override the time of the line itself. Consecutive lines
+    usually share the same second, so the result up to the second is cached.
+    The format that matched last is tried first; when it matches at the start
+    of the line the other formats aren't tried at all.'''
+
+    FORMATS = [
+        re.compile(r'(?P<year>\d{4})-(?P<month>\d\d)-(?P<day>\d\d)[T ](?P<hour>\d\d):(?P<minute>\d\d):(?P<second>\d\d)(?P<fraction>[.,]\d+)?(?P<zone>Z|[+-]\d\d:?\d\d)?'),
+        re.compile(r'\[(?P<day>\d\d)/(?P<monthname>[A-Z][a-z]{2})/(?P<year>\d{4}):(?P<hour>\d\d):(?P<minute>\d\d):(?P<second>\d\d)(?P<fraction>)(?: (?P<zone>[+-]\d{4}))?\]'),
+        re.compile(r'^(?P<monthname>[A-Z][a-z]{2}) (?P<day>[ \d]\d) (?P<hour>\d\d):(?P<minute>\d\d):(?P<second>\d\d)(?P<fraction>[.,]\d+)?(?P<zone>)(?P<year>)'),
+    ]
+
+    max_cache_size = 1024
+
+    def __init__(self):
+        self.formats = list(self.FORMATS)
+        self.cache = {}
+
+    def parse(self, line):
+        '''Return the time found in a line as a unix timestamp, or None'''
+        match = None
+        for (candidate_index, regex) in enumerate(self.formats):
+            candidate = regex.search(line)
+            if candidate is not None and (match is None or candidate.start() < match.start()):
+                (index, match) = (candidate_index, candidate)
+                if not match.start():
+                    break
+        if match is None:
+            return None
+
+        if index:
+            # Trying this format first from now on
+            self.formats.insert(0, self.formats.pop(index))
+
+        key = match.group(0)[:match.start('second') - match.start(0) + 2] + (match.group('zone') or '')
+        try:
+            timestamp = self.cache[key]
+        except KeyError:
+            try:
+                timestamp = self._convert(match)
+            except (ValueError, KeyError, OverflowError):
+                return None
+            if len(self.cache) >= self.max_cache_size:
+                self.cache.clear()
+            self.cache[key] = timestamp
+
+        fraction = match.group('fraction')
+        if fraction:
+            return timestamp + float('0.' + fraction[1:])
+        return timestamp
+
+    def _convert(self, match):
+        '''Return the unix timestamp of a match, ignoring the fraction of the second'''
+        groups = match.groupdict()
+        month = int(groups['month']) if groups.get('month') else MONTHS[groups['monthname']]
+        values = [int(groups['day']), int(groups['hour']), int(groups['minute']), int(groups['second'])]
+
+        if not groups['year']:
+            # Syslog doesn't mention the year
+            now = time.time()
+            year = time.localtime(now).tm_year
+            for candidate in (year, year - 1):
+                try:
+                    timestamp = time.mktime(self._time_tuple(candidate, month, values))
+                except ValueError:
+                    # Such as February 29th
+                    continue
+                if timestamp <= now + 86400:
+                    return timestamp
+            raise ValueError('No year in the last 12 months has {}'.format(match.group(0)))
+
+        time_tuple = self._time_tuple(int(groups['year']), month, values)
+        zone = groups['zone']
+        if not zone:
+            return time.mktime(time_tuple)
+        if zone == 'Z':
+            return calendar.timegm(time_tuple)
+        offset = int(zone[1:3]) * 3600 + int(zone[-2:]) * 60
+        if zone[0] == '-':
+            offset = -offset
+        return calendar.timegm(time_tuple) - offset
+
+    @staticmethod
+    def _time_tuple(year, month, values):
+        '''Return a tuple for mktime and timegm, raises ValueError for dates that don't exist
+
+        Both functions would silently turn October 45th into November 14th.'''
+        datetime.datetime(year, month, *values)
+        return tuple([year, month] + values + [0, 0, -1])
+
+
+class HyperLogLog(object):
+    '''Estimate the number of distinct items using a fixed amount of memory
+
+    Uses 2**precision one-byte registers; the standard error of the estimate
+    is 1.04 / sqrt(2**precision), which is about 1.6% for the default.'''
+
+    def __init__(self, precision=12):
+        if not 4 <= precision <= 16:
+            raise ValueError('Precision should be between 4 and 16')
+        self.precision = precision
+        self.size = 1 << precision
+        self.registers = bytearray(self.size)
+        self._zeros = self.size
+        # The sum of 2**-register over all registers, scaled by 2**64 to keep
+        # it an exact integer that can be updated whenever a register changes
+        self._scaled_sum = self.size << 64
+
+        if self.size >= 128:
+            self._alpha = 0.7213 / (1 + 1.079 / self.size)
+        else:
+            self._alpha = {16: 0.673, 32: 0.697, 64: 0.709}[self.size]
+
+    def __repr__(self):
+        return '{}(precision={}, cardinality={})'.format(self.__class__.__name__, self.precision, self.cardinality())
+
+    def add(self, item):
+        '''Add an item, returns True when the estimate changed'''
+        if isinstance(item, unicode):
+            item = item.encode('UTF-8')
+        value = int(hashlib.md5(item).hexdigest()[:16], 16)  # 64 bits
+
+        index = value >> (64 - self.precision)
+        remainder = value & ((1 << (64 - self.precision)) - 1)
+        rank = (64 - self.precision) - remainder.bit_length() + 1
+
+        old_rank = self.registers[index]
+        if rank <= old_rank:
+            return False
+
+        self.registers[index] = rank
+        if old_rank == 0:
+            self._zeros -= 1
+        self._scaled_sum += (1 << (64 - rank)) - (1 << (64 - old_rank))
+        return True
+
+    def cardinality(self):
+        size = self.size
+        estimate = self._alpha * size * size * (1 << 64) / float(self._scaled_sum)
+        if estimate <= 2.5 * size and self._zeros:
+            # Small range correction: linear counting
+            return size * math.log(float(size) / self._zeros)
+        return estimate
+
+
+class SpaceSaving(object):
+    '''Track the most frequent items using a fixed number of counters
+
+    Implements the Space-Saving algorithm: when a new item arrives while all
+    counters are in use, the item with the lowest count is evicted and the new
+    item takes over its count. Counts are therefore overestimated by at most
+    the value in errors[item]. Every item that occurs more often than
+    total / capacity is guaranteed to be tracked.'''
+
+    def __init__(self, capacity):
+        if capacity < 1:
+            raise ValueError('Capacity should be at least 1')
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+
+    def __repr__(self):
+        return '{}(capacity={}, counts={})'.format(self.__class__.__name__, self.capacity, self.counts)
+
+    def add(self, item, count=1):
+        '''Count an item, returns the item that got evicted (if any)'''
+        evicted = None
+        if item not in self.counts:
+            floor = 0
+            if len(self.counts) >= self.capacity:
+                evicted = min(self.counts, key=self.counts.get)
+                floor = self.counts.pop(evicted)
+                del self.errors[evicted]
+            self.counts[item] = floor
+            self.errors[item] = floor
+        self.counts[item] += count
+        return evicted
+
+    def top(self, amount=None):
+        '''Return a list with (item, count) tuples, most frequent first'''
+        ranking = sorted(self.counts.items(), key=lambda item_count: item_count[1], reverse=True)
+        if amount is None:
+            return ranking
+        return ranking[:amount]
+
+
+class AbstractCardinalityLineHandler(AbstractLineHandler):
+    '''Base class for counting distinct items, such as client IPs
+
+    Define a labelled Gauge on class level as `gauge` and implement extract,
+    which returns the item found in a line (or None). The label values given
+    on instantiation are used for the gauge. Memory usage is fixed, see
+    HyperLogLog.'''
+
+    gauge = None
+    precision = 12
+
+    def __init__(self, *labelvalues):
+        super(AbstractCardinalityLineHandler, self).__init__()
+        self.labelvalues = labelvalues
+        self.hyperloglog = HyperLogLog(self.precision)
+
+    @abc.abstractmethod
+    def extract(self, line):
+        '''Return the item to count, or None to ignore the line'''
+        pass
+
+    def reload_from(self, old_handler):
+        if old_handler.labelvalues == self.labelvalues and old_handler.precision == self.precision:
+            self.hyperloglog = old_handler.hyperloglog
+
+    def process(self, line):
+        item = self.extract(line)
+        if item is not None and self.hyperloglog.add(item):
+            self.gauge.labels(*self.labelvalues).set(round(self.hyperloglog.cardinality()))
+
+
+class AbstractTopLineHandler(AbstractLineHandler):
+    '''Base class for tracking the most frequent items, such as failing users
+
+    Define a labelled Gauge on class level as `gauge`; its last label receives
+    the item. Implement extract, which returns the item found in a line (or
+    None). At most `capacity` items are tracked and exported: when an item is
+    evicted its label is removed from the gauge, see SpaceSaving.'''
+
+    gauge = None
+    capacity = 20
+
+    def __init__(self, *labelvalues):
+        super(AbstractTopLineHandler, self).__init__()
+        self.labelvalues = labelvalues
+        self.spacesaving = SpaceSaving(self.capacity)
+
+    @abc.abstractmethod
+    def extract(self, line):
+        '''Return the item to count, or None to ignore the line'''
+        pass
+
+    def reload_from(self, old_handler):
+        if old_handler.labelvalues == self.labelvalues and old_handler.capacity == self.capacity:
+            self.spacesaving = old_handler.spacesaving
+
+    def process(self, line):
+        item = self.extract(line)
+        if item is None:
+            return
+
+        evicted = self.spacesaving.add(item, self.sample_weight)
+        if evicted is not None:
+            try:
+                self.gauge.remove(*(self.labelvalues + (evicted,)))
+            except KeyError:
+                pass
+        self.gauge.labels(*(self.labelvalues + (item,))).set(self.spacesaving.counts[item])
+
+
+def observe_many(histogram, values, weight=1):
+    '''Observe a batch of values with a (non-labelled) Histogram
+
+    Equivalent to calling histogram.observe() for every value, but the values
+    are binned in one go and the histogram is only locked once.'''
+    values = sorted(values)
+    bucket_counts = []
+    start = 0
+    for upper_bound in histogram._upper_bounds:
+        end = bisect.bisect_right(values, upper_bound, start)
+        bucket_counts.append(end - start)
+        start = end
+
+    with histogram._lock:
+        histogram._sum += math.fsum(values) * weight
+        for (index, count) in enumerate(bucket_counts):
+            if count:
+                histogram._buckets[index] += count * weight
+
+
+class AbstractHistogramLineHandler(AbstractLineHandler):
+    '''Base class for building histograms from a numeric field, such as request times
+
+    Define a labelled Histogram on class level as `histogram` and implement
+    extract, which returns the number found in a line (or None). The label
+    values given on instantiation are used for the histogram. Values are
+    collected per batch of lines and added to the histogram at once, see
+    observe_many.'''
+
+    histogram = None
+
+    def __init__(self, *labelvalues):
+        super(AbstractHistogramLineHandler, self).__init__()
+        self.labelvalues = labelvalues
+
+    @abc.abstractmethod
+    def extract(self, line):
+        '''Return the value to observe, or None to ignore the line'''
+        pass
+
+    def process(self, line):
+        self.process_lines([line])
+
+    def process_lines(self, lines):
+        values = array.array('d')
+        for line in lines:
+            try:
+                value = self.extract(line)
+                if value is not None:
+                    values.append(float(value))
+            except Exception:
+                self.logger.exception('Failed to process line %s', repr(line))
+
+        if values:
+            observe_many(self.histogram.labels(*self.labelvalues), values, self.sample_weight)
+
+
+class IngestionLagLineHandler(AbstractLineHandler):
+    '''LineHandler that exports how far behind the processing of a file is
+
+    The time in the last line that has a timestamp (see TimestampParser) is
+    compared with the time it gets processed. The gauge isn't annotated with
+    the time of that line: the lag is measured now.'''
+
+    lag = Gauge('ingestion_lag_seconds', 'Seconds between the time in the last processed line and the moment it was processed', ['filename'])  # noqa
+
+    testcases = False  # The outcome depends on the current time
+
+    def __init__(self, filename):
+        super(IngestionLagLineHandler, self).__init__()
+        self.filename = filename
+
+    def process(self, line):
+        self.process_lines([line])
+
+    def process_lines(self, lines):
+        # Only the last line matters
+        for line in reversed(lines):
+            timestamp = self.parse_timestamp(line)
+            if timestamp is not None:
+                self.lag.labels(self.filename).set(time.time() - timestamp)
+                return
+
+
+class RecordAssembler(object):
+    '''Joins the lines of multi-line records, such as stack traces
+
+    A line that matches the `start` regular expression starts a new record,
+    every other line belongs to the record before it. A record is complete
+    once the next one starts, when no lines were added to it for `timeout`
+    seconds, or when it grew beyond `max_size` characters. The lines of a
+    record are joined with newlines.
+
+    One instance keeps the state of one file.'''
+
+    def __init__(self, start, timeout=1.0, max_size=64 * 1024):
+        if isinstance(start, basestring):
+            start = re.compile(start)
+        self.start = start
+        self.timeout = timeout
+        self.max_size = max_size
+        self.pending = []
+        self.pending_size = 0
+        self.last_added = None
+
+    def __repr__(self):
+        return '{}(start={!r}, timeout={}, max_size={})'.format(self.__class__.__name__, self.start.pattern, self.timeout, self.max_size)
+
+    def add(self, lines, now=None):
+        '''Return the records that are complete after adding lines'''
+        records = []
+        match = self.start.match
+        pending = self.pending
+        size = self.pending_size
+        for line in lines:
+            if pending and match(line):
+                records.append('\n'.join(pending))
+                pending = []
+                size = 0
+            pending.append(line)
+            size += len(line) + 1
+            if size > self.max_size:
+                records.append('\n'.join(pending))
+                pending = []
+                size = 0
+        self.pending = pending
+        self.pending_size = size
+        if lines:
+            self.last_added = time.time() if now is None else now
+        return records
+
+    def flush(self, now=None, force=False):
+        '''Return the pending record if it timed out (or when forced)'''
+        if not self.pending:
+            return []
+        if not force and self.time_until_flush(now) > 0:
+            return []
+        record = '\n'.join(self.pending)
+        self.pending = []
+        self.pending_size = 0
+        return [record]
+
+    def time_until_flush(self, now=None):
+        '''Return the seconds until the pending record times out, or None if there is none'''
+        if not self.pending:
+            return None
+        if now is None:
+            now = time.time()
+        return max(0, self.last_added + self.timeout - now)
+
 
 class FileStats(object):
     '''Track handlers for a spefic file'''
 
+    # One instance per followed file, which can be thousands
+    __slots__ = ('watchdescriptor', '_filehandle', 'position_in_file', 'inode', 'missing_since', 'unprocessed', 'handlers', 'timings')
+
     def __init__(self, handlers):
         self.watchdescriptor = None
         self._filehandle = None
         self.position_in_file = None
+        self.inode = None
+        self.missing_since = None
         self.unprocessed = ''
         self.handlers = handlers
+        self.timings = {}  # handler -> [batches, lines, seconds]
 
     def __repr__(self):
         return '{}(handle={}, position={}, handlers={})'.format(self.__class__.__name__, self._filehandle, self.position_in_file, self.handlers)
@@ -87,8 +596,22 @@ class FileStats(object):
         self._filehandle = handle
         if handle is None:
             self.position_in_file = -1
+            self.inode = None
+            if self.missing_since is None:
+                self.missing_since = time.time()
         else:
             self.position_in_file = handle.tell()
+            self.inode = os.fstat(handle.fileno()).st_ino
+            self.missing_since = None
+
+    def record_timing(self, handler, lines, seconds):
+        try:
+            timing = self.timings[handler]
+        except KeyError:
+            timing = self.timings[handler] = [0, 0, 0.0]
+        timing[0] += 1
+        timing[1] += lines
+        timing[2] += seconds
 
     def __del__(self):
         self.disable()
@@ -100,6 +623,9 @@ class FileStats(object):
             pass
         self.watchdescriptor = None
         self._filehandle = None
+        self.inode = None
+        if self.missing_since is None:
+            self.missing_since = time.time()
         self.unprocessed = ''
 
 
@@ -121,13 +647,30 @@ class CloudedEvent(inotify.watcher.Event):
 
 class DirStats(object):
 
+    __slots__ = ('filenames',)
+
     def __init__(self, filenames):
-        self.filenames = filenames
+        self.filenames = set(filenames)
 
     def __repr__(self):
         return '{}(filenames={})'.format(self.__class__.__name__, self.filenames)
 
 
+def open_logfile(path, from_beginning_of_file=False):
+    '''Open a logfile for following it, or return None if that isn't possible'''
+    try:
+        # Opening an unbuffered stream, requires since we use select
+        handle = codecs.open(path, 'r', 'UTF-8', 'replace', 0)
+        if from_beginning_of_file:
+            handle.seek(0)
+        else:
+            handle.seek(0, 2)  # 0 bytes from the end of the file
+    except IOError:
+        # This can happen when the file doesn't exist yet.
+        return None
+    return handle
+
+
 def ignore_untracked(func):
     def wrapped(self, event, *args, **kwargs):
         if event.fullpath not in self.filestats:
@@ -169,10 +712,15 @@ class MyWatcher(Watcher):
         'isdir': 'Event occurred on a directory',
     }
 
-    def __init__(self, *args, **kwargs):
-        super(MyWatcher, self).__init__(*args, **kwargs)
+    overflowcount = Counter('inotify_overflows', 'The number of times the kernel dropped inotify events for logfile_exporter.')  # noqa
+
+    def __init__(self, bufsize=None):
+        '''bufsize: default size of the buffer to read events into (see read)'''
+        super(MyWatcher, self).__init__()
         self.filestats = {}
         self.dirstats = {}
+        self.bufsize = bufsize
+        self.assemblers = {}
 
     def add_handler(self, path, handler):
         try:
@@ -181,26 +729,187 @@ class MyWatcher(Watcher):
             self.filestats[path] = FileStats([handler])
         self.add(path)
 
-    def add(self, path, from_beginning_of_file=False):
-        # Registering a handler on the file itself
-        filestats = self.filestats[path]
+    def add_handlers(self, logfiles, threads=OPEN_THREADS):
+        '''Register many (filename, handler) pairs at once
+
+        Does the same as calling add_handler for every pair, but every
+        directory is handled once. With threads > 1 the files are opened by a
+        pool of threads; that only pays off when opening a file blocks for a
+        while, such as on network filesystems.'''
+        paths = []
+        known_paths = set()
+        for (path, handler) in logfiles:
+            filestats = self.filestats.get(path)
+            if filestats is None:
+                filestats = self.filestats[path] = FileStats([handler])
+            else:
+                filestats.handlers.append(handler)
+            if filestats.watchdescriptor is None and path not in known_paths:
+                known_paths.add(path)
+                paths.append(path)
+
+        directories = {}
+        for path in paths:
+            self.watch_file(path)
+            dirname = os.path.dirname(path)
+            try:
+                directories[dirname].append(path)
+            except KeyError:
+                directories[dirname] = [path]
+        for dirname in sorted(directories):
+            self.watch_directory(dirname, directories[dirname])
+
+        if threads > 1 and len(paths) > 1:
+            pool = ThreadPool(min(threads, len(paths)))
+            try:
+                handles = pool.map(open_logfile, paths)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            handles = [open_logfile(path) for path in paths]
+
+        for (path, handle) in zip(paths, handles):
+            self.replace_filehandle(path, handle)
 
-        if filestats.watchdescriptor is None:
+    def set_assembler(self, path, assembler):
+        '''Feed the handlers of a file whole records instead of lines, see RecordAssembler
+
+        The assembler stays when the handlers get reloaded.'''
+        if assembler is None:
+            self.assemblers.pop(path, None)
+        else:
+            self.assemblers[path] = assembler
+
+    def flush_records(self, now=None, force=False):
+        '''Feed the records that timed out to the handlers of their file'''
+        for (path, assembler) in list(self.assemblers.items()):
+            records = assembler.flush(now, force)
+            if records and path in self.filestats:
+                self.feed_handlers(path, records)
+
+    def flush_record(self, path):
+        '''Feed the pending record of a file to its handlers right away
+
+        Used when the lines that follow won't continue that record, because
+        the file was truncated, replaced or is no longer followed.'''
+        try:
+            assembler = self.assemblers[path]
+        except KeyError:
+            return
+        records = assembler.flush(force=True)
+        if records and path in self.filestats:
+            self.feed_handlers(path, records)
+
+    def time_until_next_flush(self, now=None):
+        '''Return the seconds until flush_records has work, or None if no record is pending'''
+        timeouts = [assembler.time_until_flush(now) for assembler in self.assemblers.values()]
+        timeouts = [timeout for timeout in timeouts if timeout is not None]
+        return min(timeouts) if timeouts else None
+
+    def remove_file(self, path):
+        '''Stop following a file and forget its handlers'''
+        self.flush_record(path)
+        filestats = self.filestats.pop(path)
+        if filestats.watchdescriptor is not None:
             try:
-                filestats.watchdescriptor = super(MyWatcher, self).add(path, FILE_EVENTS_TO_WATCH)
-            except OSError as ex:
-                logger.info('Non-fatal problem: failed to open %s: %s', path, ex)
-            self.reset_filehandle(path, from_beginning_of_file)
+                self.remove_path(path)
+            except (inotify.watcher.InotifyWatcherException, OSError) as ex:
+                logger.debug('Failed to stop monitoring %s: %s', path, ex)
+        filestats.disable()
 
-        # Registering a handler on the folder that contains the file, to detect file renames
         dirname = os.path.dirname(path)
         try:
-            self.dirstats[dirname].filenames.append(path)
+            dirstats = self.dirstats[dirname]
+        except KeyError:
+            return
+        dirstats.filenames.discard(path)
+        if not dirstats.filenames:
+            del self.dirstats[dirname]
+            try:
+                self.remove_path(dirname)
+            except (inotify.watcher.InotifyWatcherException, OSError) as ex:
+                logger.debug('Failed to stop monitoring %s: %s', dirname, ex)
+
+    def expire_files(self, ttl, now=None):
+        '''Stop following files that have been missing for more than ttl seconds'''
+        if now is None:
+            now = time.time()
+        for (path, filestats) in list(self.filestats.items()):
+            if filestats.missing_since is not None and now - filestats.missing_since > ttl:
+                logger.info('No longer following %s: missing for more than %s seconds', path, ttl)
+                self.remove_file(path)
+
+    def reload_handlers(self, logfiles):
+        '''Replace all handlers with the given (filename, handler) pairs
+
+        Files that are no longer mentioned will no longer be followed and new
+        files will be followed from their end. Files that stay keep their
+        filehandle and position, only their handlers are replaced. A new
+        handler takes over the state of the old handler of the same type, see
+        AbstractLineHandler.reload_from.'''
+        new_handlers = {}
+        paths = []
+        for (path, handler) in logfiles:
+            if path not in new_handlers:
+                new_handlers[path] = []
+                paths.append(path)
+            new_handlers[path].append(handler)
+
+        for path in list(self.filestats):
+            if path not in new_handlers:
+                logger.info('Reload: no longer following %s', path)
+                self.remove_file(path)
+
+        added = []
+        for path in paths:
+            try:
+                filestats = self.filestats[path]
+            except KeyError:
+                logger.info('Reload: now following %s', path)
+                added.extend((path, handler) for handler in new_handlers[path])
+                continue
+
+            old_handlers = list(filestats.handlers)
+            for handler in new_handlers[path]:
+                for old_handler in old_handlers:
+                    if type(old_handler) is type(handler):
+                        old_handlers.remove(old_handler)
+                        handler.reload_from(old_handler)
+                        break
+            filestats.handlers = new_handlers[path]
+            filestats.timings = {}
+
+        self.add_handlers(added)
+
+    def add(self, path, from_beginning_of_file=False):
+        if self.filestats[path].watchdescriptor is None:
+            self.watch_file(path)
+            self.reset_filehandle(path, from_beginning_of_file)
+        self.watch_directory(os.path.dirname(path), [path])
+
+    def watch_file(self, path):
+        # Registering a handler on the file itself
+        try:
+            self.filestats[path].watchdescriptor = super(MyWatcher, self).add(path, FILE_EVENTS_TO_WATCH)
+        except OSError as ex:
+            logger.info('Non-fatal problem: failed to open %s: %s', path, ex)
+
+    def watch_directory(self, dirname, paths):
+        # Registering a handler on the folder that contains the files, to detect file renames
+        try:
+            dirstats = self.dirstats[dirname]
         except KeyError:
             super(MyWatcher, self).add(dirname, DIR_EVENTS_TO_WATCH)
-            self.dirstats[dirname] = DirStats([path])
+            self.dirstats[dirname] = DirStats(paths)
+        else:
+            # Files get re-added after every rotation
+            dirstats.filenames.update(paths)
 
     def reset_filehandle(self, path, from_beginning_of_file=False):
+        self.replace_filehandle(path, open_logfile(path, from_beginning_of_file))
+
+    def replace_filehandle(self, path, handle):
         stats = self.filestats[path]
 
         # Cleanup
@@ -210,36 +919,46 @@ class MyWatcher(Watcher):
             except IOError as ex:
                 logger.info('Failed to close filehandle %s: %s', path, ex)
 
-        # Setup
-        try:
-            # Opening an unbuffered stream, requires since we use select
-            handle = codecs.open(path, 'r', 'UTF-8', 'replace', 0)
-            if from_beginning_of_file:
-                handle.seek(0)
-            else:
-                handle.seek(0, 2)  # 0 bytes from the end of the file
-        except IOError:
-            # This can happen when the file doesn't exist yet.
-            handle = None
-
         stats.filehandle = handle
         stats.unprocessed = ''
+        self.flush_record(path)
 
     def read(self, bufsize=None):
-        return [CloudedEvent(event.raw, event.path) for event in super(MyWatcher, self).read(bufsize)]
+        # Same as Watcher.read, but creating CloudedEvents right away
+        events = []
+        for raw in inotify.read(self.fd, bufsize):
+            events.append(CloudedEvent(raw, None if raw.wd == -1 else self._wds[raw.wd][0]))
+            if raw.mask & inotify.IN_IGNORED:
+                self._remove(raw.wd)
+            elif raw.mask & inotify.IN_UNMOUNT:
+                self.close()
+        return events
+
+    @classmethod
+    def dispatch_table(cls):
+        '''Return (mask, method) pairs for all event types with a process_<event type> method
+
+        The table is built once per class.'''
+        try:
+            return cls.__dict__['_dispatch_table']
+        except KeyError:
+            table = []
+            for event_type in sorted(cls._event_props):
+                handler = getattr(cls, 'process_' + event_type, None)
+                if handler is not None:
+                    table.append((getattr(inotify, 'IN_' + event_type.upper()), handler))
+            cls._dispatch_table = tuple(table)
+            return cls._dispatch_table
 
     def process_events(self, bufsize=None):
-        events = self.read(bufsize)
-        for event in events:
-            for event_type in self._event_props:
-                if getattr(event, event_type):
-                    try:
-                        handler = getattr(self, 'process_' + event_type)
-                    except AttributeError:
-                        logger.debug('No handler for %s', event_type)
-                    else:
-                        logger.debug('Calling handler for %s', event_type)
-                        handler(event)
+        if bufsize is None:
+            bufsize = self.bufsize
+        dispatch_table = self.dispatch_table()
+        for event in self.read(bufsize):
+            mask = event.mask
+            for (event_mask, handler) in dispatch_table:
+                if mask & event_mask:
+                    handler(self, event)
 
     @ignore_untracked
     def process_moved_from(self, event):
@@ -266,20 +985,26 @@ class MyWatcher(Watcher):
         self.add(event.fullpath, from_beginning_of_file=True)  # (re)start monitoring with inotify
         self.process_modify(event)
 
+    @ignore_untracked
     def process_modify(self, event):
-        filestats = self.filestats[event.fullpath]
+        self.read_new_lines(event.fullpath)
+
+    def read_new_lines(self, path):
+        '''Feed everything that was added to a file to its handlers'''
+        filestats = self.filestats[path]
 
         if filestats.filehandle is None:
-            logger.debug('Ignoring read for non-existent file %s', event.fullpath)
+            logger.debug('Ignoring read for non-existent file %s', path)
             return
 
         # first, check if the file was truncated:
         curr_size = os.fstat(filestats.filehandle.fileno()).st_size
         if curr_size < filestats.position_in_file:
-            logger.info('File %s was truncated, seeking to beginning of file', event.fullpath)
+            logger.info('File %s was truncated, seeking to beginning of file', path)
             filestats.filehandle.seek(0)
             filestats.position_in_file = 0
             filestats.unprocessed = ''
+            self.flush_record(path)
 
         try:
             partial = filestats.filehandle.read()
@@ -295,38 +1020,603 @@ class MyWatcher(Watcher):
                 filestats.unprocessed = partial[(last_newline + 1):]  # +1 because we don't care about the newline
             filestats.position_in_file = filestats.filehandle.tell()
         except IOError:
-            logger.warning('Error reading lines from file %s', event.fullpath)
+            logger.warning('Error reading lines from file %s', path)
             return
 
-        for line in lines:
-            # logger.debug('%s: %s', event.fullpath, line)
+        try:
+            assembler = self.assemblers[path]
+        except KeyError:
+            pass
+        else:
+            lines = assembler.add(lines)
+        self.feed_handlers(path, lines)
 
-            for handler in filestats.handlers:
-                try:
-                    handler.process(line)
-                except Exception:
-                    # Catching all possible exceptions: Continued service is
-                    # more important than the processing of a particular line
-                    handler.logger.exception('Failed to process line %s', repr(line))
+    def feed_handlers(self, path, lines):
+        filestats = self.filestats[path]
+        for handler in filestats.handlers:
+            start = time.time()
+            try:
+                handler.process_lines(handler.sample(lines))
+            except Exception:
+                handler.logger.exception('Failed to process lines from %s', path)
+            filestats.record_timing(handler, len(lines), time.time() - start)
+
+    def process_q_overflow(self, _event):
+        '''The kernel dropped events; check all files ourselves'''
+        logger.warning(
+            'inotify queue overflowed, checking all files for changes. Consider raising %s/max_queued_events (now %s).',
+            inotify.procfs_path,
+            inotify.max_queued_events(),
+        )
+        self.overflowcount.inc()
+        for path in list(self.filestats):
+            self.catch_up(path)
+
+    def catch_up(self, path):
+        '''Process the changes of a file without relying on inotify events
+
+        Detects growth, truncation, replacement and removal of the file by
+        comparing it with what we know in FileStats.'''
+        filestats = self.filestats[path]
+        try:
+            inode = os.stat(path).st_ino
+        except OSError:
+            inode = None
+
+        if filestats.filehandle is not None:
+            # Whatever got written to the file we were following
+            self.read_new_lines(path)
+            if inode == filestats.inode:
+                return
+
+            logger.info('File %s was replaced or removed while inotify events were lost', path)
+            try:
+                self.remove_path(path)
+            except (inotify.watcher.InotifyWatcherException, OSError) as ex:
+                logger.debug('Failed to stop monitoring %s: %s', path, ex)
+            filestats.disable()
+
+        if inode is not None:
+            self.add(path, from_beginning_of_file=True)
+            self.read_new_lines(path)
 
     def process_ignored(self, event):
         logger.debug('inotify reported it is no longer monitoring %s', event.fullpath)
         try:
             filestats = self.filestats[event.fullpath]
         except KeyError:
+            # Directories, or files we stopped following ourselves
             logger.debug('inotify reported it is no longer monitoring unknown %s', event.fullpath)
-        finally:
-            filestats.disable()
-            # If the path was in self.filestats we're interested in it...
-            if os.path.exists(event.fullpath):
-                logger.debug('inotify reported its no longer monitoring %s, readding it.', event.fullpath)
-                self.add(event.fullpath)
+            return
+
+        if filestats.watchdescriptor not in (None, event.wd):
+            # We already switched to a new watch, see catch_up
+            logger.debug('inotify reported it is no longer monitoring an old version of %s', event.fullpath)
+            return
+
+        filestats.disable()
+        # If the path was in self.filestats we're interested in it...
+        if os.path.exists(event.fullpath):
+            logger.debug('inotify reported its no longer monitoring %s, readding it.', event.fullpath)
+            self.add(event.fullpath)
+        else:
+            logger.debug('inotify reported its no longer monitoring %s.', event.fullpath)
+
+
+CONTENT_TYPE_OPENMETRICS = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+
+def annotate(metric, timestamp=None, exemplar=None, value=1):
+    '''Attach the time of a log line and/or an exemplar to a metric
+
+    Call this after changing a metric, passing the metric itself (for labelled
+    metrics the result of labels()). The timestamp is a unix timestamp; only
+    the most recent one is kept. The exemplar is a dict with labels, such as
+    {'request_id': '42'}, and value is the increment (for counters) or the
+    observed value (for histograms). Both are only exposed in the OpenMetrics
+    format, see generate_openmetrics.'''
+    if timestamp is not None and timestamp > getattr(metric, '_event_timestamp', 0):
+        metric._event_timestamp = timestamp
+
+    if exemplar is not None:
+        if hasattr(metric, '_upper_bounds'):
+            index = bisect.bisect_left(metric._upper_bounds, value)
+            try:
+                metric._exemplars[index] = (exemplar, value, timestamp)
+            except AttributeError:
+                metric._exemplars = {index: (exemplar, value, timestamp)}
+        else:
+            metric._exemplar = (exemplar, value, timestamp)
+
+
+def _format_float(value):
+    if value == float('inf'):
+        return '+Inf'
+    if value == float('-inf'):
+        return '-Inf'
+    return repr(float(value))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{{{0}}}'.format(','.join(
+        '{0}="{1}"'.format(name, unicode(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"'))
+        for (name, value) in sorted(labels.items())
+    ))
+
+
+def generate_openmetrics(registry=REGISTRY):
+    '''Return the metrics of the registry in the OpenMetrics text format
+
+    Unlike the Prometheus text format this includes the timestamps and
+    exemplars attached with annotate.'''
+    output = [exposition for (_name, exposition) in openmetrics_families(registry)]
+    output.append('# EOF\n')
+    return ''.join(output).encode('UTF-8')
+
+
+def openmetrics_families(registry=REGISTRY):
+    '''Yield the name and OpenMetrics text of every metric family, without the # EOF'''
+    with registry._lock:
+        collectors = list(registry._collectors)
+    for collector in collectors:
+        # Finding the metric objects behind the samples to get their annotations
+        if hasattr(collector, '_labelnames'):
+            with collector._lock:
+                children = dict(
+                    (frozenset(zip(collector._labelnames, labelvalues)), child)
+                    for (labelvalues, child) in collector._metrics.items()
+                )
+        else:
+            children = {frozenset(): collector}
+
+        for metric in collector.collect():
+            output = []
+            metric_type = {'untyped': 'unknown'}.get(metric._type, metric._type)
+            name = metric._name
+            if metric_type == 'counter' and name.endswith('_total'):
+                name = name[:-len('_total')]
+            output.append('# TYPE {0} {1}\n'.format(name, metric_type))
+            output.append('# HELP {0} {1}\n'.format(
+                name, metric._documentation.replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')))
+
+            for (sample_name, labels, value) in metric._samples:
+                child = children.get(frozenset((key, val) for (key, val) in labels.items() if key not in ('le', 'quantile')))
+                if metric_type == 'counter' and sample_name == metric._name:
+                    sample_name = name + '_total'
+                line = '{0}{1} {2}'.format(sample_name, _format_labels(labels), _format_float(value))
+
+                timestamp = getattr(child, '_event_timestamp', None)
+                if timestamp is not None:
+                    line += ' ' + repr(float(timestamp))
+
+                exemplar = None
+                if metric_type == 'counter':
+                    exemplar = getattr(child, '_exemplar', None)
+                elif metric_type == 'histogram' and sample_name == metric._name + '_bucket':
+                    upper_bound = float(labels['le'])
+                    exemplar = getattr(child, '_exemplars', {}).get(child._upper_bounds.index(upper_bound))
+                if exemplar is not None:
+                    (exemplar_labels, exemplar_value, exemplar_timestamp) = exemplar
+                    line += ' # {0} {1}'.format(_format_labels(exemplar_labels) or '{}', _format_float(exemplar_value))
+                    if exemplar_timestamp is not None:
+                        line += ' ' + repr(float(exemplar_timestamp))
+
+                output.append(line + '\n')
+            yield (metric._name, ''.join(output))
+
+
+def generate_exposition(output_format, registry=REGISTRY):
+    '''Return the metrics in the 'openmetrics' or 'prometheus' text format'''
+    if output_format == 'openmetrics':
+        return generate_openmetrics(registry)
+    return generate_latest(registry)
+
+
+class SeriesExpirer(object):
+    '''Forget metric series and files that have been stale for too long
+
+    Every sweep the values of all labelled counter, summary and histogram
+    series in the registry are compared with the previous sweep. Series whose
+    values didn't change for more than series_ttl seconds are removed from
+    their metric. Gauges are left alone: a gauge that stays the same, such as
+    a cardinality estimate, is still correct. Files that
+    have been missing for more than file_ttl seconds are no longer followed
+    by the watcher. A ttl of None disables that part.
+
+    Every sweep also counts the samples in the registry: a histogram series
+    counts once for every bucket, plus its sum and count.'''
+
+    expiring_types = ('counter', 'summary', 'histogram')
+
+    activeseries = Gauge('active_series', 'The number of samples (series as stored by Prometheus) in the registry of logfile_exporter.')  # noqa
+
+    def __init__(self, series_ttl=None, file_ttl=None, watcher=None, registry=REGISTRY, interval=60):
+        self.series_ttl = series_ttl
+        self.file_ttl = file_ttl
+        self.watcher = watcher
+        self.registry = registry
+        self.interval = interval
+        self.last_changed = {}  # (metric, labelvalues) -> (values, time)
+        self.next_sweep = time.time() + interval
+
+    def __repr__(self):
+        return '{}(series_ttl={}, file_ttl={}, series={})'.format(self.__class__.__name__, self.series_ttl, self.file_ttl, len(self.last_changed))
+
+    def time_until_next_sweep(self):
+        return max(0, self.next_sweep - time.time())
+
+    def tick(self):
+        '''Sweep if it's time to sweep'''
+        if time.time() >= self.next_sweep:
+            self.sweep()
+
+    def sweep(self, now=None):
+        if now is None:
+            now = time.time()
+        self.next_sweep = now + self.interval
+
+        if self.watcher is not None and self.file_ttl is not None:
+            self.watcher.expire_files(self.file_ttl, now)
+
+        with self.registry._lock:
+            collectors = list(self.registry._collectors)
+
+        series = 0
+        last_changed = {}
+        for collector in collectors:
+            if not hasattr(collector, '_labelnames'):
+                series += sum(len(metric._samples) for metric in collector.collect())
+                continue
+
+            with collector._lock:
+                children = list(collector._metrics.items())
+            for (labelvalues, child) in children:
+                values = tuple(value for (_suffix, _labels, value) in child._samples())
+                if collector._type not in self.expiring_types:
+                    series += len(values)
+                    continue
+                key = (collector, labelvalues)
+                (previous_values, changed) = self.last_changed.get(key, (None, now))
+                if previous_values != values:
+                    changed = now
+                elif self.series_ttl is not None and now - changed > self.series_ttl:
+                    logger.debug('Removing %s%s: unchanged for more than %s seconds', collector, labelvalues, self.series_ttl)
+                    with collector._lock:
+                        collector._metrics.pop(labelvalues, None)
+                    continue
+                last_changed[key] = (values, changed)
+                series += len(values)
+
+        # Only remembering what still exists
+        self.last_changed = last_changed
+        self.activeseries.set(series)
+
+
+class StaticCollector(object):
+    '''Collector (and registry) returning metrics that were already collected'''
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def collect(self):
+        return self.metrics
+
+
+class MetricsPusher(object):
+    '''Push the metrics to a Pushgateway (or compatible endpoint) over HTTP
+
+    Every interval the metric families that changed since the last time are
+    queued, and all queued batches are POSTed to the url. A POST replaces the
+    pushed families in the Pushgateway while leaving the others alone.
+
+    The connection is kept open between pushes. Failed pushes are retried
+    with an exponentially increasing delay. While failing at most max_queue
+    batches are kept: the oldest batches are merged, which keeps the latest
+    value of every family.
+
+    After start() the batches are sent by a background thread and tick()
+    only queues them, so a slow or hanging endpoint doesn't hold up the
+    caller.
+
+    With push_format='openmetrics' the OpenMetrics text format is pushed,
+    which includes the timestamps and exemplars attached with annotate. Only
+    use that for receivers that accept OpenMetrics; the Pushgateway needs
+    the default Prometheus text format.'''
+
+    pushfailures = Counter('push_failures', 'The number of failed attempts of logfile_exporter to push metrics.')  # noqa
+
+    def __init__(self, url, interval=15, registry=REGISTRY, max_queue=10, timeout=10, min_backoff=1, max_backoff=300, push_format='prometheus'):
+        if max_queue < 1:
+            raise ValueError('max_queue should be at least 1')
+        if push_format not in ('prometheus', 'openmetrics'):
+            raise ValueError('Unknown push_format {}'.format(push_format))
+        parsed = urlparse.urlsplit(url)
+        if parsed.scheme != 'http':
+            raise ValueError('Only http:// urls are supported: {}'.format(url))
+        self.host = parsed.hostname
+        self.port = parsed.port or 80
+        self.path = parsed.path or '/'
+        if parsed.query:
+            self.path += '?' + parsed.query
+
+        self.interval = interval
+        self.registry = registry
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.push_format = push_format
+
+        self.queue = collections.deque()
+        self.condition = threading.Condition()  # Guards the queue
+        self.last_queued = {}  # name -> exposition of the family
+        self.backoff = 0
+        self.retry_at = 0
+        self.next_push = time.time() + interval
+        self.connection = None
+        self.thread = None
+        self.stopping = False
+
+    def __repr__(self):
+        return '{}(host={}, port={}, path={}, queue={})'.format(self.__class__.__name__, self.host, self.port, self.path, len(self.queue))
+
+    def time_until_next_push(self):
+        return max(0, self.next_push - time.time())
+
+    def collect(self):
+        '''Queue the families that changed since they were last queued'''
+        if self.push_format == 'openmetrics':
+            families = openmetrics_families(self.registry)
+        else:
+            families = ((metric._name, generate_latest(StaticCollector([metric]))) for metric in self.registry.collect())
+
+        batch = collections.OrderedDict()
+        for (name, exposition) in families:
+            if self.last_queued.get(name) != exposition:
+                batch[name] = exposition
+                self.last_queued[name] = exposition
+        if not batch:
+            return
+
+        with self.condition:
+            self.queue.append(batch)
+            self._trim_queue()
+            self.condition.notify()
+
+    def _trim_queue(self):
+        while len(self.queue) > self.max_queue:
+            merged = self.queue.popleft()
+            merged.update(self.queue[0])
+            self.queue[0] = merged
+
+    def send(self, batch):
+        if self.connection is None:
+            self.connection = httplib.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        try:
+            if self.push_format == 'openmetrics':
+                (body, content_type) = (u''.join(batch.values()).encode('UTF-8') + '# EOF\n', CONTENT_TYPE_OPENMETRICS)
             else:
-                logger.debug('inotify reported its no longer monitoring %s.', event.fullpath)
+                (body, content_type) = (''.join(batch.values()), CONTENT_TYPE_LATEST)
+            self.connection.request('POST', self.path, body, {'Content-Type': content_type})
+            response = self.connection.getresponse()
+            response.read()  # Required before the connection can be reused
+        except (httplib.HTTPException, socket.error):
+            self.connection.close()
+            self.connection = None
+            raise
+        if response.status >= 400:
+            raise IOError('Error from {}:{}: {} {}'.format(self.host, self.port, response.status, response.reason))
+
+    def send_queued(self):
+        '''Send everything queued, returns True on success'''
+        while True:
+            with self.condition:
+                if not self.queue:
+                    break
+                batch = self.queue.popleft()
+            try:
+                self.send(batch)
+            except (IOError, httplib.HTTPException, socket.error) as ex:
+                with self.condition:
+                    self.queue.appendleft(batch)
+                    self._trim_queue()
+                self.pushfailures.inc()
+                self.backoff = min(max(self.backoff * 2, self.min_backoff), self.max_backoff)
+                self.retry_at = time.time() + self.backoff
+                logger.warning('Failed to push metrics to %s:%s, retrying in %s seconds: %s', self.host, self.port, self.backoff, ex)
+                return False
+
+        self.backoff = 0
+        return True
+
+    def push(self):
+        '''Collect and send everything queued, returns True on success'''
+        self.collect()
+        if self.send_queued():
+            self.next_push = time.time() + self.interval
+            return True
+        self.next_push = self.retry_at
+        return False
+
+    def tick(self):
+        '''Push (or only collect, after start()) if it's time to push'''
+        if time.time() < self.next_push:
+            return
+        if self.thread is None:
+            self.push()
+        else:
+            self.collect()
+            self.next_push = time.time() + self.interval
+
+    def flush(self, attempts=3):
+        '''Push right away, retrying up to attempts times'''
+        for _attempt in range(attempts):
+            if self.push():
+                return True
+            time.sleep(self.backoff)
+        return False
+
+    def start(self):
+        '''Send the queued batches from a background thread from now on'''
+        self.stopping = False
+        self.thread = threading.Thread(target=self._send_in_background, name='MetricsPusher')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        '''Queue the last changes and stop the background thread after it tried to send them'''
+        self.collect()
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+        self.thread.join(self.timeout + 1)
+        if self.thread.is_alive():
+            logger.warning('Gave up waiting for the last push to %s:%s', self.host, self.port)
+        self.thread = None
+
+    def _send_in_background(self):
+        while True:
+            with self.condition:
+                while not self.stopping and not (self.queue and time.time() >= self.retry_at):
+                    if self.queue:
+                        self.condition.wait(self.retry_at - time.time())
+                    else:
+                        self.condition.wait()
+                stopping = self.stopping
+            self.send_queued()
+            if stopping:
+                return
+
+
+def sample_stacks(thread_id, seconds, interval=0.01):
+    '''Sample the stack of a thread for a while
+
+    Returns a Counter with how often every stack was seen. The stacks are
+    collapsed into one line, outermost function first, as used by
+    flamegraph.pl.'''
+    stacks = collections.Counter()
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        if frame is None:
+            # The thread is gone
+            break
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append('{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+            frame = frame.f_back
+        del frame
+        stacks[';'.join(reversed(stack))] += 1
+        time.sleep(interval)
+    return stacks
+
+
+def debug_state(watcher):
+    '''Return the state of the followed files, for /debug/state'''
+    files = {}
+    for (path, filestats) in list(watcher.filestats.items()):
+        try:
+            size = os.fstat(filestats.filehandle.fileno()).st_size
+        except (AttributeError, OSError, ValueError):
+            # Missing file, or closed by the ingest thread in the meantime
+            size = None
+        handlers = []
+        for handler in list(filestats.handlers):
+            (batches, lines, seconds) = filestats.timings.get(handler, (0, 0, 0.0))
+            handlers.append({
+                'handler': _handler_name(type(handler)),
+                'batches': batches,
+                'lines': lines,
+                'seconds': seconds,
+            })
+        files[path] = {
+            'size': size,
+            'position': filestats.position_in_file,
+            'unprocessed': len(filestats.unprocessed),
+            'inode': filestats.inode,
+            'missing_since': filestats.missing_since,
+            'handlers': handlers,
+        }
+    return {
+        'time': time.time(),
+        'files': files,
+        'directories': dict((dirname, sorted(dirstats.filenames)) for (dirname, dirstats) in list(watcher.dirstats.items())),
+    }
+
+
+def preferred_format(accept):
+    '''Return 'openmetrics' or 'prometheus', whichever an Accept header prefers
+
+    OpenMetrics has to be asked for explicitly, with a q-value above 0 and
+    not below that of the Prometheus text format.'''
+    qualities = {}
+    for media_range in accept.split(','):
+        parts = media_range.split(';')
+        media_type = parts[0].strip().lower()
+        quality = 1.0
+        for parameter in parts[1:]:
+            (key, _sep, value) = parameter.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[media_type] = max(quality, qualities.get(media_type, 0.0))
+    openmetrics = qualities.get('application/openmetrics-text', 0.0)
+    text = max(qualities.get(media_type, 0.0) for media_type in ('text/plain', 'text/*', '*/*'))
+    if openmetrics > 0 and openmetrics >= text:
+        return 'openmetrics'
+    return 'prometheus'
 
 
 class MoreSilentMetricsHandler(MetricsHandler):
-    '''A more silent version of the vanilla MetricsHandler'''
+    '''A more silent version of the vanilla MetricsHandler
+
+    Serves the OpenMetrics format to clients that prefer it when the server
+    has openmetrics set, and the /debug/ endpoints when the server is a
+    DebugHTTPServer.'''
+
+    def do_GET(self):
+        if self.path.startswith('/debug/') and getattr(self.server, 'watcher', None) is not None:
+            self.do_debug()
+            return
+
+        if not getattr(self.server, 'openmetrics', False) or preferred_format(self.headers.get('Accept', '')) != 'openmetrics':
+            # Old-style class, so no super()
+            MetricsHandler.do_GET(self)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE_OPENMETRICS)
+        self.end_headers()
+        self.wfile.write(generate_openmetrics(REGISTRY))
+
+    def do_debug(self):
+        url = urlparse.urlparse(self.path)
+        if url.path == '/debug/state':
+            content_type = 'application/json'
+            body = json.dumps(debug_state(self.server.watcher), indent=2, sort_keys=True)
+        elif url.path == '/debug/profile':
+            try:
+                seconds = float(urlparse.parse_qs(url.query).get('seconds', ['30'])[0])
+            except ValueError:
+                self.send_error(400, 'seconds should be a number')
+                return
+            seconds = max(0, min(seconds, MAX_PROFILE_SECONDS))
+            content_type = 'text/plain; charset=utf-8'
+            stacks = sample_stacks(self.server.ingest_thread, seconds)
+            body = ''.join('{} {}\n'.format(stack, count) for (stack, count) in stacks.most_common())
+        else:
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.end_headers()
+        self.wfile.write(body)
 
     def log_request(self, code='-', *args, **kwargs):
         if code == 200:
@@ -341,6 +1631,9 @@ class MoreRobustHTTPServer(HTTPServer):
     Unlike the vanilla vesion this won't stop functioning once a broken pipe is
     encoutered.'''
 
+    # Serve OpenMetrics to scrapers that prefer it, see MoreSilentMetricsHandler
+    openmetrics = False
+
     def _handle_request_noblock(self):
         try:
             # No super as HTTPServer is an old-style class
@@ -349,41 +1642,262 @@ class MoreRobustHTTPServer(HTTPServer):
             logger.info('Socket error.')
 
 
-def start_http_server(portnr):
+class DebugHTTPServer(ThreadingMixIn, MoreRobustHTTPServer):
+    '''MoreRobustHTTPServer that also serves the /debug/ endpoints
+
+    - /debug/state: the state of the files the watcher follows, as JSON
+    - /debug/profile?seconds=30: samples the stack of the ingest thread and
+      returns how often every stack was seen
+
+    Requests are handled in their own thread, so profiling doesn't block the
+    ingest thread it samples.'''
+
+    daemon_threads = True
+
+    def __init__(self, server_address, handler_class, watcher, ingest_thread=None):
+        MoreRobustHTTPServer.__init__(self, server_address, handler_class)
+        self.watcher = watcher
+        if ingest_thread is None:
+            ingest_thread = threading.current_thread().ident
+        self.ingest_thread = ingest_thread
+
+
+def start_http_server(portnr, watcher=None, openmetrics=False):
+    '''Start serving the metrics; with a watcher the /debug/ endpoints are enabled too
+
+    With openmetrics scrapers that prefer the OpenMetrics format get it.'''
     server_address = ('', portnr)
-    httpd = MoreRobustHTTPServer(server_address, MoreSilentMetricsHandler)
+    if watcher is not None:
+        httpd = DebugHTTPServer(server_address, MoreSilentMetricsHandler, watcher)
+    else:
+        httpd = MoreRobustHTTPServer(server_address, MoreSilentMetricsHandler)
+    httpd.openmetrics = openmetrics
     return httpd
 
 
-def run_offline(setting, logfiles):
-    raise NotImplementedError()
+OFFLINE_CHUNK_SIZE = 1024 * 1024
+OFFLINE_MIN_RANGE_SIZE = 16 * 1024 * 1024
+
+
+def split_file(path, parts):
+    '''Split a file into at most `parts` (start, end) byte ranges
+
+    Every range starts at the beginning of a line.'''
+    size = os.path.getsize(path)
+    boundaries = [0]
+    with open(path, 'rb') as handle:
+        for index in range(1, parts):
+            position = size * index // parts
+            if position <= boundaries[-1]:
+                continue
+            # Finding the first line that starts at or after position
+            handle.seek(position - 1)
+            handle.readline()
+            boundaries.append(handle.tell())
+    boundaries.append(size)
+    return [(start, end) for (start, end) in zip(boundaries, boundaries[1:]) if start < end]
+
+
+def read_lines(path, start=0, end=None):
+    '''Yield lists with the lines between two byte positions of a file'''
+    with open(path, 'rb') as handle:
+        handle.seek(start)
+        remaining = (os.fstat(handle.fileno()).st_size if end is None else end) - start
+        unprocessed = b''
+        while remaining > 0:
+            data = handle.read(min(OFFLINE_CHUNK_SIZE, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            last_newline = data.rfind(b'\n')
+            if last_newline == -1:
+                unprocessed += data
+                continue
+            lines = (unprocessed + data[:last_newline]).decode('UTF-8', 'replace').splitlines()
+            unprocessed = data[(last_newline + 1):]
+            yield lines
+        if unprocessed:
+            # The file is complete, so there won't be a newline anymore
+            yield unprocessed.decode('UTF-8', 'replace').splitlines()
+
+
+def process_file(path, handlers, start=0, end=None, assembler=None):
+    '''Feed (part of) a file to handlers
+
+    With an assembler the handlers get whole records instead of lines, see
+    RecordAssembler.'''
+    def feed(lines):
+        for handler in handlers:
+            try:
+                handler.process_lines(handler.sample(lines))
+            except Exception:
+                handler.logger.exception('Failed to process lines from %s', path)
+
+    for lines in read_lines(path, start, end):
+        if assembler is not None:
+            lines = assembler.add(lines)
+        feed(lines)
+    if assembler is not None:
+        feed(assembler.flush(force=True))
+
+
+# (path, handlers, metrics) to process; set before forking the worker
+# processes so they don't have to be pickled
+_offline_work = []
+
+
+def _process_file_range(byte_range):
+    '''Process part of a file in a worker process, returns the metric_state of the metrics'''
+    (path, handlers, metrics) = _offline_work
+    for metric in metrics:
+        # Only reporting what this part of the file adds
+        swap_metric_values(metric)
+    process_file(path, handlers, *byte_range)
+    return [metric_state(metric) for metric in metrics]
+
+
+def process_file_in_parallel(path, handlers, jobs):
+    '''Feed a file to handlers using multiple processes
+
+    The file is split into ranges of lines which are processed by copies of
+    the handlers in separate processes. Afterwards the counters, summaries and
+    histograms of the handlers are merged back into this process; gauges and
+    the state of the handlers themselves are lost, so only use this for
+    handlers that are order_independent.'''
+    metrics = []
+    for handler in handlers:
+        for metric in handler_metrics(type(handler)):
+            if metric not in metrics:
+                metrics.append(metric)
+    for metric in metrics:
+        if metric._type not in ('counter', 'summary', 'histogram'):
+            logger.warning('Values of %s metric %s can not be merged after processing %s in parallel', metric._type, metric, path)
+
+    byte_ranges = split_file(path, jobs)
+    _offline_work[:] = [path, handlers, metrics]
+    pool = multiprocessing.Pool(min(jobs, len(byte_ranges)))
+    try:
+        results = pool.map(_process_file_range, byte_ranges)
+    finally:
+        pool.close()
+        pool.join()
+        _offline_work[:] = []
+
+    for states in results:
+        for (metric, state) in zip(metrics, states):
+            if metric._type in ('counter', 'summary', 'histogram'):
+                merge_metric_state(metric, state)
+
+
+def run_offline(settings, logfiles, assemblers=None):
+    '''Feed the existing content of the logfiles to the handlers
+
+    With settings.offline_jobs > 1 big files whose handlers are all
+    order_independent are processed by multiple processes, see
+    process_file_in_parallel. Files with a RecordAssembler in assemblers
+    (a dict keyed by filename) are always processed by this process, since
+    records could span the parts of the file.'''
+    if assemblers is None:
+        assemblers = {}
+    paths = []
+    handlers = {}
+    for (path, handler) in logfiles:
+        if path not in handlers:
+            paths.append(path)
+            handlers[path] = []
+        handlers[path].append(handler)
+
+    for path in paths:
+        try:
+            size = os.path.getsize(path)
+        except OSError as ex:
+            logger.warning('Skipping %s: %s', path, ex)
+            continue
+
+        jobs = min(settings.offline_jobs, size // OFFLINE_MIN_RANGE_SIZE)
+        if jobs > 1 and path not in assemblers and all(handler.order_independent for handler in handlers[path]):
+            logger.info('Processing %s using %s processes', path, jobs)
+            process_file_in_parallel(path, handlers[path], jobs)
+        else:
+            logger.info('Processing %s', path)
+            process_file(path, handlers[path], assembler=assemblers.get(path))
+
 
+def run_online(settings, logfiles, reload_logfiles=None, assemblers=None):
+    '''Follow the logfiles and serve the metrics until max_polls is reached
 
-def run_online(settings, logfiles):
+    When reload_logfiles is given it is called on SIGHUP; it should return a
+    new list with (filename, handler) pairs or None to keep the current one.
+    assemblers is a dict with a RecordAssembler per filename, see
+    MyWatcher.set_assembler.'''
 
     READ_ONLY = select.POLLIN | select.POLLPRI | select.POLLHUP | select.POLLERR
     # READ_WRITE = READ_ONLY | select.POLLOUT
 
     poller = select.poll()
 
-    http_server = start_http_server(settings.port)
+    filesystem_server = MyWatcher(bufsize=settings.inotify_bufsize)
+    poller.register(filesystem_server, READ_ONLY)
+
+    http_server = start_http_server(
+        settings.port,
+        filesystem_server if settings.debug_endpoints else None,
+        openmetrics=settings.scrape_openmetrics,
+    )
     logger.info('Now listening for HTTP requests on port %s', settings.port)
     poller.register(http_server, READ_ONLY)
 
-    filesystem_server = MyWatcher()
-    poller.register(filesystem_server, READ_ONLY)
-
-    for (filename, handler) in logfiles:
-        filesystem_server.add_handler(filename, handler)
+    for (filename, assembler) in (assemblers or {}).items():
+        filesystem_server.set_assembler(filename, assembler)
+    filesystem_server.add_handlers(logfiles, threads=settings.open_threads)
 
     pollcount = Counter('pollcount', 'The number of poll events processed by logfile_exporter.')  # noqa
 
+    reload_requested = []
+    if reload_logfiles is not None:
+        signal.signal(signal.SIGHUP, lambda _signum, _frame: reload_requested.append(True))
+
+    pusher = None
+    if settings.push_url:
+        pusher = MetricsPusher(settings.push_url, settings.push_interval, push_format=settings.push_format)
+        pusher.start()
+        logger.info('Pushing metrics to %s every %s seconds', settings.push_url, settings.push_interval)
+
+    expirer = None
+    if settings.series_ttl or settings.file_ttl:
+        expirer = SeriesExpirer(
+            series_ttl=settings.series_ttl or None,
+            file_ttl=settings.file_ttl or None,
+            watcher=filesystem_server,
+            interval=max(1, min(60, min(ttl for ttl in (settings.series_ttl, settings.file_ttl) if ttl) / 2)),
+        )
+
     loopcount = 0
     while settings.max_polls <= 0 or loopcount < settings.max_polls:
-        events = poller.poll(POLL_TIMEOUT)
+        timeout = POLL_TIMEOUT
+        if pusher is not None:
+            timeout = min(timeout, pusher.time_until_next_push() * 1000)
+        if expirer is not None:
+            timeout = min(timeout, expirer.time_until_next_sweep() * 1000)
+        until_flush = filesystem_server.time_until_next_flush()
+        if until_flush is not None:
+            timeout = min(timeout, until_flush * 1000)
+        try:
+            events = poller.poll(timeout)
+        except select.error as ex:
+            if ex.args[0] != errno.EINTR:
+                raise
+            events = []
         pollcount.inc()
         loopcount += 1
 
+        if reload_requested:
+            del reload_requested[:]
+            logger.info('Reloading handlers.')
+            new_logfiles = reload_logfiles()
+            if new_logfiles is not None:
+                filesystem_server.reload_handlers(new_logfiles)
+
         for fd, _event in events:
             if fd == http_server.fileno():
                 http_server._handle_request_noblock()
@@ -392,26 +1906,259 @@ def run_online(settings, logfiles):
             else:
                 logger.warning('Event from an unknown file descriptor')
 
+        filesystem_server.flush_records()
+        if pusher is not None:
+            pusher.tick()
+        if expirer is not None:
+            expirer.tick()
+
+    filesystem_server.flush_records(force=True)
+    if pusher is not None:
+        pusher.stop()
     logger.info('Terminating program.')
 
 
-def run_testcases(handlers):
+def _is_metric(value):
+    return not inspect.isclass(value) and hasattr(value, '_type') and hasattr(value, 'collect')
+
+
+def _code_names(code):
+    '''Return the global and attribute names used by code, including nested functions'''
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if inspect.iscode(const):
+            names.update(_code_names(const))
+    return names
+
+
+def handler_metric_references(handler_type):
+    '''Return (owner, name, metric) for every Prometheus metric a handler can use
+
+    These are the metrics defined on class level of the handler and its base
+    classes (the owner is the class), and the module level metrics the code
+    of those classes refers to by name (the owner is the module).'''
+    references = []
+    for cls in inspect.getmro(handler_type):
+        names = set()
+        for (name, value) in sorted(vars(cls).items()):
+            if _is_metric(value):
+                references.append((cls, name, value))
+            code = getattr(getattr(value, '__func__', value), '__code__', None)
+            if code is not None:
+                names.update(_code_names(code))
+        module = sys.modules.get(cls.__module__)
+        if module is not None:
+            for name in sorted(names):
+                value = getattr(module, name, None)
+                if _is_metric(value):
+                    references.append((module, name, value))
+    return references
+
+
+def handler_metrics(handler_type):
+    '''Return the Prometheus metrics of a handler, see handler_metric_references'''
+    metrics = []
+    for (_owner, _name, metric) in handler_metric_references(handler_type):
+        if metric not in metrics:
+            metrics.append(metric)
+    return metrics
+
+
+def swap_metric_values(metric, values=None):
+    '''Replace the values of a Prometheus metric
+
+    Without values the metric is emptied. Returns the old values, which can
+    be passed to this function to restore them.'''
+    with metric._lock:
+        old_values = dict(
+            (name, value) for (name, value) in vars(metric).items()
+            if name in ('_metrics', '_value', '_count', '_sum', '_buckets')
+        )
+        if values is None:
+            values = {}
+            for name in old_values:
+                if name == '_metrics':
+                    values[name] = {}
+                elif name == '_buckets':
+                    values[name] = [0.0] * len(old_values[name])
+                else:
+                    values[name] = 0.0
+        for (name, value) in values.items():
+            setattr(metric, name, value)
+    return old_values
+
+
+METRIC_TYPES = {
+    'counter': Counter,
+    'gauge': Gauge,
+    'summary': Summary,
+    'histogram': Histogram,
+}
+
+
+def fresh_metric(metric):
+    '''Return an empty metric like the given one, that isn't registered anywhere'''
+    family = metric.collect()[0]
+    labelnames = getattr(metric, '_labelnames', ())
+    if labelnames:
+        kwargs = dict(metric._kwargs)
+    elif metric._type == 'histogram':
+        kwargs = {'buckets': metric._upper_bounds}
+    else:
+        kwargs = {}
+    return METRIC_TYPES[metric._type](family._name, family._documentation, labelnames, registry=None, **kwargs)
+
+
+def metric_state(metric):
+    '''Return the values of a metric per label values (None if unlabelled)'''
+    with metric._lock:
+        children = dict(getattr(metric, '_metrics', {None: metric}))
+    state = {}
+    for (labelvalues, child) in children.items():
+        with child._lock:
+            state[labelvalues] = dict(
+                (name, value) for (name, value) in vars(child).items()
+                if name in ('_value', '_count', '_sum', '_buckets', '_event_timestamp', '_exemplar', '_exemplars')
+            )
+    return state
+
+
+def merge_metric_state(metric, state):
+    '''Add values returned by metric_state to a metric'''
+    for (labelvalues, values) in state.items():
+        child = metric if labelvalues is None else metric.labels(*labelvalues)
+        with child._lock:
+            for (name, value) in values.items():
+                if name == '_buckets':
+                    child._buckets = [old + new for (old, new) in zip(child._buckets, value)]
+                elif name == '_event_timestamp':
+                    child._event_timestamp = max(value, getattr(child, name, 0))
+                elif name == '_exemplar':
+                    child._exemplar = value
+                elif name == '_exemplars':
+                    child._exemplars = dict(getattr(child, name, {}))
+                    child._exemplars.update(value)
+                else:
+                    setattr(child, name, getattr(child, name) + value)
+
+
+def handler_fingerprint(handler_type):
+    '''Return a hash of the source code behind a handler
+
+    The complete modules of the handler and its base classes are used, so
+    changes to module level helpers (such as regular expressions) are
+    noticed as well. Returns None when the source code is not available.'''
+    digest = hashlib.sha1()
+    modules = []
+    for cls in inspect.getmro(handler_type):
+        module = sys.modules.get(cls.__module__)
+        if module is None or module in modules or cls.__module__ == '__builtin__':
+            continue
+        modules.append(module)
+        try:
+            digest.update(inspect.getsource(module))
+        except (IOError, TypeError):
+            return None
+    return digest.hexdigest()
+
+
+def _handler_name(handler_type):
+    return '{}.{}'.format(handler_type.__module__, handler_type.__name__)
+
+
+def _load_testcase_cache(path):
+    try:
+        with open(path) as handle:
+            return json.load(handle)
+    except (IOError, ValueError) as ex:
+        logger.debug('Not using testcase cache %s: %s', path, ex)
+        return {}
+
+
+def _save_testcase_cache(path, cache):
+    try:
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(path, 'w') as handle:
+            json.dump(cache, handle, indent=1, sort_keys=True)
+    except (IOError, OSError) as ex:
+        logger.info('Non-fatal problem: failed to write testcase cache %s: %s', path, ex)
+
+
+# Handler types to test; set before forking the worker processes so they
+# don't have to be pickled
+_testcase_handler_types = []
+
+
+def _run_handler_testcases(index):
+    '''Run the testcases of a single handler type
+
+    Returns None when there are no testcases, otherwise a tuple with the nr.
+    of tests ran and lists with the tracebacks of failures and errors.'''
     import unittest
     from tests import load_tests_from_handler
 
+    tests = load_tests_from_handler(unittest.defaultTestLoader, _testcase_handler_types[index])
+    if not tests:
+        return None
+    result = tests(unittest.result.TestResult())
+    return (
+        result.testsRun,
+        [traceback for (_test, traceback) in result.failures],
+        [traceback for (_test, traceback) in result.errors],
+    )
+
+
+def run_testcases(handlers, cache_path=None, jobs=1):
+    '''Run the testcases of the given handlers
+
+    The testcases use fresh copies of the metrics of the handlers (see
+    handler_metric_references and fresh_metric), so they can't disturb the
+    metrics that are being served; they fail when a served metric changes
+    anyway.
+    With jobs > 1 the handler types are tested in parallel processes, unless
+    this process has other threads: a forked child could deadlock on a lock
+    (of a metric or of logging) that such a thread held at the time. When
+    cache_path is given, handler types which passed before and have not
+    changed since (see handler_fingerprint) are skipped.'''
+
     # Removing duplicate handlers
-    unique_handlers = set([type(handler) for handler in handlers])
+    unique_handlers = sorted(set([type(handler) for handler in handlers]), key=_handler_name)
     logger.info('Running testcases')
 
+    cache = {}
+    if cache_path:
+        cache = _load_testcase_cache(cache_path)
+
     failures = 0
     errors = 0
 
+    handler_types = []
     for handler_type in unique_handlers:
-        tests = load_tests_from_handler(unittest.defaultTestLoader, handler_type)
-        if tests:
-            result = tests(unittest.result.TestResult())
-            failure_count = len(result.failures)
-            error_count = len(result.errors)
+        cached = cache.get(_handler_name(handler_type))
+        if cached is not None and cached['fingerprint'] == handler_fingerprint(handler_type):
+            logger.info('%s skipped %s testcases: unchanged since they last passed.', handler_type, cached['testsRun'])
+        else:
+            handler_types.append(handler_type)
+
+    _testcase_handler_types[:] = handler_types
+    if jobs > 1 and len(handler_types) > 1 and threading.active_count() == 1:
+        pool = multiprocessing.Pool(min(jobs, len(handler_types)))
+        try:
+            results = pool.map(_run_handler_testcases, range(len(handler_types)))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_run_handler_testcases(index) for index in range(len(handler_types))]
+    _testcase_handler_types[:] = []
+
+    for (handler_type, result) in zip(handler_types, results):
+        if result:
+            (tests_run, failure_tracebacks, error_tracebacks) = result
+            failure_count = len(failure_tracebacks)
+            error_count = len(error_tracebacks)
 
             failures += failure_count
             errors += error_count
@@ -419,11 +2166,19 @@ def run_testcases(handlers):
             logger_func = logger.info
             if failure_count or error_count:
                 logger_func = logger.warning
+                for traceback in failure_tracebacks + error_tracebacks:
+                    logger.debug('%s testcase failed: %s', handler_type, traceback)
+                for traceback in error_tracebacks:
+                    logger.warning('%s testcase error: %s', handler_type, traceback.strip().splitlines()[-1])
+            elif cache_path:
+                fingerprint = handler_fingerprint(handler_type)
+                if fingerprint is not None:
+                    cache[_handler_name(handler_type)] = {'fingerprint': fingerprint, 'testsRun': tests_run}
 
             logger_func(
                 '%s executed %s testcases: %s failures, %s errors.',
                 handler_type,
-                result.testsRun,
+                tests_run,
                 failure_count,
                 error_count,
             )
@@ -434,17 +2189,41 @@ def run_testcases(handlers):
             else:
                 logger.warning('%s has no testcases.', handler_type)
 
+    if cache_path and handler_types:
+        _save_testcase_cache(cache_path, cache)
+
     return (failures, errors)
 
 
-def run(myfiles, configure_basic_logger=True):
+def run(myfiles, configure_basic_logger=True, multiline=None):
+    '''Run the exporter for a list with (filename, handler) pairs
+
+    Instead of a list a function returning such a list can be given; it will
+    be called again when the process receives a SIGHUP to reload the handlers
+    without losing the position in the files.
+
+    multiline is a dict with a RecordAssembler per filename whose handlers
+    should get whole multi-line records instead of lines.'''
 
     parser = argparse.ArgumentParser()
     parser.add_argument('-v', '--verbose', action='count', default=0)
     parser.add_argument('-q', '--quiet', action='count', default=0)
     parser.add_argument('-p', '--port', default=9123, type=int, help='Port to listen on')
     parser.add_argument('-o', '--offline', action='store_true', help='Feed the existing log files to the handlers and then quit.')
+    parser.add_argument('--offline-format', choices=['openmetrics', 'prometheus'], default='openmetrics', help='Format of the metrics written in offline mode; only openmetrics includes the times of the log lines')
+    parser.add_argument('--offline-jobs', default=1, type=int, help='Nr. of processes to use for big files in offline mode, only used when all handlers of a file are order independent')
+    parser.add_argument('--push-url', help='Also push the metrics to this url, such as http://pushgateway:9091/metrics/job/logfile_exporter')
+    parser.add_argument('--push-interval', default=15, type=float, help='Seconds between pushes')
+    parser.add_argument('--scrape-openmetrics', action='store_true', help='Serve the OpenMetrics format, with the times of the log lines, to scrapers that prefer it; counters are then named with a _total suffix')
+    parser.add_argument('--push-format', choices=['prometheus', 'openmetrics'], default='prometheus', help='Format to push in; only openmetrics includes the times of the log lines, but the Pushgateway needs prometheus')
     parser.add_argument('-t', '--testcases', choices=['skip', 'strict', 'run', 'run-then-quit'], default='run')
+    parser.add_argument('--testcase-cache', default=os.path.expanduser('~/.cache/logfile_exporter/testcases.json'), help='File to remember which handlers passed their testcases; empty to always run all testcases')
+    parser.add_argument('--testcase-jobs', default=multiprocessing.cpu_count(), type=int, help='Nr. of handler types to test in parallel')
+    parser.add_argument('--series-ttl', default=0, type=float, help='Remove labelled counter, summary and histogram series that did not change for this many seconds; 0 to keep them forever')
+    parser.add_argument('--file-ttl', default=0, type=float, help='Stop following files that are missing for this many seconds; 0 to keep waiting for them forever')
+    parser.add_argument('--debug-endpoints', action='store_true', help='Serve /debug/state and /debug/profile?seconds=30 for troubleshooting; anyone who can reach the port can use them')
+    parser.add_argument('--open-threads', default=OPEN_THREADS, type=int, help='Nr. of threads opening the logfiles on startup; only helps when opening files is slow, such as on network filesystems')
+    parser.add_argument('--inotify-bufsize', default=None, type=int, help='Size in bytes of the buffer to read inotify events into; by default all pending events are read at once')
     parser.add_argument('--max-polls', default=-1, type=int, help=argparse.SUPPRESS)
 
     args = parser.parse_args()
@@ -457,20 +2236,50 @@ def run(myfiles, configure_basic_logger=True):
             format='%(asctime)s %(levelname)-10s [%(name)s] %(message)s',
         )
 
-    if args.testcases in ['strict', 'run', 'run-then-quit']:
-        (failures, errors) = run_testcases([handler for (_filename, handler) in myfiles])
+    def testcases_passed(logfiles):
+        '''Run the testcases, returns False if they failed in strict mode'''
+        if args.testcases == 'skip':
+            return True
+        (failures, errors) = run_testcases(
+            [handler for (_filename, handler) in logfiles],
+            cache_path=args.testcase_cache,
+            jobs=args.testcase_jobs,
+        )
+        failed = max(failures, errors) > 0
 
         if args.testcases == 'run-then-quit':
-            exit_code = 0 if max(failures, errors) == 0 else 9
+            exit_code = 9 if failed else 0
             sys.exit(exit_code)
-        if args.testcases == 'strict' and max(failures, errors) > 0:
-            logger.error('Aborting program; not all testcases passed.')
-            sys.exit(9)
+        return not failed or args.testcases != 'strict'
+
+    reload_logfiles = None
+    if callable(myfiles):
+        get_logfiles = myfiles
+
+        def reload_logfiles():
+            try:
+                logfiles = get_logfiles()
+            except Exception:
+                logger.exception('Not reloading; failed to get the new handlers.')
+                return None
+            if not testcases_passed(logfiles):
+                logger.error('Not reloading; not all testcases passed.')
+                return None
+            return logfiles
+
+        myfiles = get_logfiles()
+
+    if not testcases_passed(myfiles):
+        logger.error('Aborting program; not all testcases passed.')
+        sys.exit(9)
 
     if args.offline:
-        run_offline(args, myfiles)
+        run_offline(args, myfiles, multiline)
+        if args.push_url:
+            MetricsPusher(args.push_url, push_format=args.push_format).flush()
+        sys.stdout.write(generate_exposition(args.offline_format))
     else:
         try:
-            run_online(args, myfiles)
+            run_online(args, myfiles, reload_logfiles, multiline)
         except KeyboardInterrupt:
             pass
@@ -1,11 +1,20 @@
 #!/usr/bin/env python2
 
+# Python imports
+import re
+
 # 3rd party imports
 from prometheus_client import Counter
+from prometheus_client import Gauge
+from prometheus_client import Histogram
 
 # Local imports
 from logfile_exporter import run
+from logfile_exporter import AbstractCardinalityLineHandler
+from logfile_exporter import AbstractHistogramLineHandler
 from logfile_exporter import AbstractLineHandler
+from logfile_exporter import AbstractTopLineHandler
+from logfile_exporter import IngestionLagLineHandler
 
 
 class LineCounter(AbstractLineHandler):
@@ -17,8 +26,16 @@ class LineCounter(AbstractLineHandler):
 
     Always define counters on class level, creating them on instance level can
     result in weird behaviour because running testcases will make new classes.
+
+    For very busy files set sample_every to only process 1 in N lines; the
+    counter is increased with sample_weight to keep an estimate of the total.
+
+    Since every line is counted on its own, the order of the lines doesn't
+    matter: in offline mode big files can be split among multiple processes.
     '''
 
+    order_independent = True
+
     linecounter = Counter('linecount', 'Nr. of analyzed lines', ['filename'])  # noqa
 
     testcases = [
@@ -40,12 +57,14 @@ Line three''',
     def process(self, line):
         # This is the part that you should modify to get your own behaviour
         # For now we'll simply increase the counter for every line processed
-        self.linecounter.labels(self.filename).inc()
+        self.linecounter.labels(self.filename).inc(self.sample_weight)
 
 
 class LetterCounter(AbstractLineHandler):
     '''Example LineHandler that counts the number of letters'''
 
+    order_independent = True
+
     lettercounter = Counter('lettercount', 'Nr. of letters in the log files', ['filename', 'lettertype'])  # noqa
 
     testcases = [
@@ -71,6 +90,98 @@ class LetterCounter(AbstractLineHandler):
         self.lettercounter.labels(self.filename, 'lower').inc(len([x for x in line if x.islower()]))
 
 
+FAILED_LOGIN = re.compile(r'Failed password for (?:invalid user )?(?P<user>\S+) from (?P<source>\S+)')
+
+
+class FailedLoginSources(AbstractCardinalityLineHandler):
+    '''Example LineHandler that estimates the number of distinct IPs with failed logins
+
+    The memory usage stays the same no matter how many IPs are seen.'''
+
+    gauge = Gauge('failed_login_sources', 'Estimated nr. of distinct IPs with failed logins', ['filename'])  # noqa
+
+    testcases = [
+        {
+            'input': '''Oct 18 12:34:56 host sshd[1]: Failed password for root from 10.0.0.1 port 22 ssh2
+Oct 18 12:34:57 host sshd[2]: Failed password for invalid user admin from 10.0.0.2 port 22 ssh2
+Oct 18 12:34:58 host sshd[3]: Accepted password for quinox from 10.0.0.3 port 22 ssh2
+Oct 18 12:34:59 host sshd[4]: Failed password for root from 10.0.0.1 port 22 ssh2''',
+            'expected': [
+                ('failed_login_sources', [('filename', '/var/log/auth.log')], 2.0),
+            ]
+        }
+    ]
+    testcase_args = ['/var/log/auth.log']
+
+    def extract(self, line):
+        match = FAILED_LOGIN.search(line)
+        if match:
+            return match.group('source')
+
+
+class FailedLoginUsers(AbstractTopLineHandler):
+    '''Example LineHandler that tracks the users with the most failed logins
+
+    Only the top `capacity` users are exported, so a brute force attack with
+    random usernames won't result in an unlimited amount of labels.'''
+
+    gauge = Gauge('failed_login_top_users', 'Nr. of failed logins for the most failing users', ['filename', 'user'])  # noqa
+    capacity = 2
+
+    testcases = [
+        {
+            'input': '''Oct 18 12:34:56 host sshd[1]: Failed password for root from 10.0.0.1 port 22 ssh2
+Oct 18 12:34:57 host sshd[2]: Failed password for invalid user admin from 10.0.0.2 port 22 ssh2
+Oct 18 12:34:58 host sshd[3]: Failed password for root from 10.0.0.1 port 22 ssh2
+Oct 18 12:34:59 host sshd[4]: Failed password for invalid user test from 10.0.0.2 port 22 ssh2''',
+            'expected': [
+                ('failed_login_top_users', [('filename', '/var/log/auth.log'), ('user', 'root')], 2.0),
+                ('failed_login_top_users', [('filename', '/var/log/auth.log'), ('user', 'test')], 2.0),
+            ]
+        }
+    ]
+    testcase_args = ['/var/log/auth.log']
+
+    def extract(self, line):
+        match = FAILED_LOGIN.search(line)
+        if match:
+            return match.group('user')
+
+
+class RequestTime(AbstractHistogramLineHandler):
+    '''Example LineHandler that builds a histogram of request times
+
+    Expects an access log with the request time in seconds as the last field,
+    such as nginx with $request_time at the end of its log_format.'''
+
+    order_independent = True
+
+    histogram = Histogram('request_seconds', 'Time spent on requests', ['filename'], buckets=(0.1, 0.5, 1.0))  # noqa
+
+    testcases = [
+        {
+            'input': '''10.0.0.1 - - [18/Oct/2026:12:34:56 +0000] "GET / HTTP/1.1" 200 612 0.050
+10.0.0.1 - - [18/Oct/2026:12:34:57 +0000] "GET /slow HTTP/1.1" 200 612 0.750
+10.0.0.2 - - [18/Oct/2026:12:34:58 +0000] "GET /broken HTTP/1.1" 502 166 -
+10.0.0.2 - - [18/Oct/2026:12:34:59 +0000] "GET /slower HTTP/1.1" 200 612 2.500''',
+            'expected': [
+                ('request_seconds_bucket', [('filename', '/var/log/nginx/access.log'), ('le', '0.1')], 1.0),
+                ('request_seconds_bucket', [('filename', '/var/log/nginx/access.log'), ('le', '0.5')], 1.0),
+                ('request_seconds_bucket', [('filename', '/var/log/nginx/access.log'), ('le', '1.0')], 2.0),
+                ('request_seconds_bucket', [('filename', '/var/log/nginx/access.log'), ('le', '+Inf')], 3.0),
+                ('request_seconds_count', [('filename', '/var/log/nginx/access.log')], 3.0),
+                ('request_seconds_sum', [('filename', '/var/log/nginx/access.log')], 3.3),
+            ]
+        }
+    ]
+    testcase_args = ['/var/log/nginx/access.log']
+
+    def extract(self, line):
+        field = line.rpartition(' ')[2]
+        if field != '-':
+            return float(field)
+
+
 class PrintingLineHandler(AbstractLineHandler):
     '''Example LineHandler that prints all log lines
 
@@ -100,5 +211,8 @@ if __name__ == '__main__':
         ('/var/log/syslog', LineCounter(filename='/var/log/syslog')),
         ('/var/log/syslog', LetterCounter(filename='/var/log/syslog')),
         ('/var/log/syslog', PrintingLineHandler(filename='/var/log/syslog')),
+        ('/var/log/syslog', IngestionLagLineHandler('/var/log/syslog')),
         ('/var/log/auth.log', LineCounter(filename='/var/log/auth.log')),
+        ('/var/log/auth.log', FailedLoginSources('/var/log/auth.log')),
+        ('/var/log/auth.log', FailedLoginUsers('/var/log/auth.log')),
     ])
@@ -1,22 +1,60 @@
 #!/usr/bin/env python2
 
 # Python
+from BaseHTTPServer import BaseHTTPRequestHandler
+from BaseHTTPServer import HTTPServer
+from SocketServer import ThreadingMixIn
 from os.path import join
+import argparse
 import imp
+import inspect
+import json
 import logging
 import os
 import select
 import shutil
 import tempfile
+import threading
+import time
 import unittest
+import urllib2
 
 # 3rd part
+import inotify
 import prometheus_client
 
 # Local
+from logfile_exporter import AbstractCardinalityLineHandler
+from logfile_exporter import AbstractHistogramLineHandler
 from logfile_exporter import AbstractLineHandler
+from logfile_exporter import DebugHTTPServer
+from logfile_exporter import HyperLogLog
+from logfile_exporter import IngestionLagLineHandler
 from logfile_exporter import MetaAbstractLineHandler
+from logfile_exporter import MetricsPusher
 from logfile_exporter import MyWatcher
+from logfile_exporter import MoreRobustHTTPServer
+from logfile_exporter import MoreSilentMetricsHandler
+from logfile_exporter import RecordAssembler
+from logfile_exporter import SeriesExpirer
+from logfile_exporter import SpaceSaving
+from logfile_exporter import StaticCollector
+from logfile_exporter import TimestampParser
+from logfile_exporter import annotate
+from logfile_exporter import fresh_metric
+from logfile_exporter import generate_exposition
+from logfile_exporter import generate_openmetrics
+from logfile_exporter import handler_metric_references
+from logfile_exporter import metric_state
+from logfile_exporter import observe_many
+from logfile_exporter import preferred_format
+from logfile_exporter import process_file
+from logfile_exporter import read_lines
+from logfile_exporter import run_offline
+from logfile_exporter import run_testcases
+from logfile_exporter import split_file
+from logfile_exporter import swap_metric_values
+import logfile_exporter
 
 
 logger = logging.getLogger('logfile_exporter.tests')
@@ -36,44 +74,69 @@ class RecordingAbstractLineHandler(AbstractLineHandler):
         self.lines.append(line)
 
 
-def noop_collect(*args, **kwargs):
-    return []
+def served_metric_state():
+    '''Return (metric, metric_state) for the metrics in the default registry
+
+    The failures of MetricsPusher are left out, those are counted by the
+    thread that pushes.'''
+    with prometheus_client.REGISTRY._lock:
+        collectors = list(prometheus_client.REGISTRY._collectors)
+    return [
+        (collector, metric_state(collector)) for collector in collectors
+        if hasattr(collector, '_type') and collector is not MetricsPusher.pushfailures
+    ]
 
 
 class BaseTestLineHandler(unittest.TestCase):
+
+    '''Runs the testcases of a handler against its own metrics
+
+    The metrics of the handler (see handler_metric_references) are replaced
+    by empty copies on their class or module during the test, so the metrics
+    that are being served stay untouched. This is safe because the handlers
+    only process lines on the thread that runs the testcases. Testcases fail
+    when a served metric changes anyway, such as one the handler reaches
+    through another module.'''
+
+    references = []
+
+    @classmethod
+    def setUpClass(cls):
+        cls.served_state = served_metric_state()
+
+    @classmethod
+    def tearDownClass(cls):
+        changed = [
+            metric.collect()[0]._name for (metric, state) in served_metric_state()
+            if state != dict(cls.served_state).get(metric)
+        ]
+        if changed:
+            raise AssertionError(
+                'The testcases of {} changed the served metrics {}; only metrics defined on class level or '
+                'referred to by name on module level are replaced during testcases'.format(
+                    type(cls.instance).__name__, ', '.join(sorted(changed))))
+
     def setUp(self):
-        # Disabling auto collectors
-        self._PROCESS_COLLECTOR_collect = prometheus_client.PROCESS_COLLECTOR.collect
-        prometheus_client.PROCESS_COLLECTOR.collect = noop_collect
+        self.registry = prometheus_client.CollectorRegistry()
+        fresh_metrics = {}
+        self._replaced = []
+        for (owner, name, metric) in self.references:
+            if id(metric) not in fresh_metrics:
+                fresh_metrics[id(metric)] = fresh_metric(metric)
+                self.registry.register(fresh_metrics[id(metric)])
+            setattr(owner, name, fresh_metrics[id(metric)])
+            self._replaced.append((owner, name, metric))
 
     def tearDown(self):
-        # Resetting all metrics
-        for metric in prometheus_client.REGISTRY._collectors:
-            try:
-                type_ = metric._type
-            except AttributeError:
-                # Special metrics such as ProcessCollector. Should be dealt
-                # with on a case-by-base basis
-                continue
-
-            if type_ == 'counter':
-                with metric._lock:
-                    metric._metrics = {}
-            elif type_ == 'gauge':
-                with metric._lock:
-                    metric._metrics = {}
-            else:
-                logger.warning('Failed to reset %s.%s: unknown Prometheus type %s', handler, var, obj._type)
-
-        # Re-enabling auto collectors
-        prometheus_client.PROCESS_COLLECTOR.collect = self._PROCESS_COLLECTOR_collect
+        for (owner, name, metric) in reversed(self._replaced):
+            setattr(owner, name, metric)
 
     def _test(self, testcase):
         for line in testcase['input'].splitlines():
             self.instance.process(line)
 
         result = []
-        for metric in prometheus_client.REGISTRY.collect():
+        for metric in self.registry.collect():
             for (name, tags, value) in metric._samples:
                 result.append((
                     name,
@@ -93,9 +156,12 @@ class BaseTestLineHandler(unittest.TestCase):
 def load_tests_from_handler(loader, handler):
     '''Return all testcases for a handler'''
 
+    if inspect.isabstract(handler):
+        # Base classes such as AbstractLineHandler
+        return []
+
     if handler.testcases is None:
-        if handler != AbstractLineHandler:
-            logger.warning('Handler %s has no testcases.', handler)
+        logger.warning('Handler %s has no testcases.', handler)
         return []
 
     if handler.testcases is False:
@@ -112,6 +178,7 @@ def load_tests_from_handler(loader, handler):
     if handler.testcase_kwargs is not None:
         kwargs = handler.testcase_kwargs
     Derived.instance = handler(*args, **kwargs)
+    Derived.references = handler_metric_references(handler)
 
     # Setting up testcases
     for (index, testcase) in enumerate(handler.testcases, start=1):
@@ -431,6 +498,1197 @@ class TestWatcher(unittest.TestCase):
             self.poll()
             self.assertEqual(self.recorder.lines, ['12:34 First entry', '12:35 Second entry'])
 
+    def test_sampling(self):
+        syslog = join(self.folder, 'syslog')
+        self.recorder.sample_every = 3
+        self.watcher.add_handler(syslog, self.recorder)
+
+        with open(syslog, 'w') as handle:
+
+            handle.write('line 1\nline 2\nline 3\nline 4\n')
+            handle.flush()
+
+            self.poll()
+
+            self.assertEqual(self.recorder.lines, ['line 1', 'line 4'])
+
+            handle.write('line 5\nline 6\nline 7\n')
+            handle.flush()
+
+            self.poll()
+
+            self.assertEqual(self.recorder.lines, ['line 1', 'line 4', 'line 7'])
+
+    def test_reload_handlers(self):
+        syslog = join(self.folder, 'syslog')
+        messages = join(self.folder, 'messages')
+        authlog = join(self.folder, 'auth.log')
+        messages_recorder = RecordingAbstractLineHandler()
+        self.watcher.add_handler(syslog, self.recorder)
+        self.watcher.add_handler(messages, messages_recorder)
+
+        with open(syslog, 'w') as syslog_handle, open(messages, 'w') as messages_handle:
+            syslog_handle.write('12:34 First')
+            syslog_handle.flush()
+            messages_handle.write('12:34 First entry\n')
+            messages_handle.flush()
+            self.poll()
+
+            new_recorder = RecordingAbstractLineHandler()
+            authlog_recorder = RecordingAbstractLineHandler()
+            self.watcher.reload_handlers([(syslog, new_recorder), (authlog, authlog_recorder)])
+            self.poll()
+
+            self.assertEqual(sorted(self.watcher.filestats), [authlog, syslog])
+            self.assertEqual(self.watcher.filestats[syslog].handlers, [new_recorder])
+
+            syslog_handle.write(' entry\n')
+            syslog_handle.flush()
+            messages_handle.write('12:35 Second entry\n')
+            messages_handle.flush()
+            with open(authlog, 'w') as authlog_handle:
+                authlog_handle.write('12:35 Login\n')
+            self.poll()
+
+        self.assertEqual(self.recorder.lines, [])
+        self.assertEqual(new_recorder.lines, ['12:34 First entry'])
+        self.assertEqual(messages_recorder.lines, ['12:34 First entry'])
+        self.assertEqual(authlog_recorder.lines, ['12:35 Login'])
+
+    def test_records(self):
+        syslog = join(self.folder, 'syslog')
+        self.watcher.set_assembler(syslog, RecordAssembler(r'\d\d:\d\d '))
+        self.watcher.add_handler(syslog, self.recorder)
+
+        with open(syslog, 'w') as handle:
+            handle.write('12:34 Traceback (most recent call last):\n  File "app.py", line 1\nValueError\n')
+            handle.flush()
+            self.poll()
+            self.assertEqual(self.recorder.lines, [])
+            self.assertIsNotNone(self.watcher.time_until_next_flush())
+
+            handle.write('12:35 Started\n')
+            handle.flush()
+            self.poll()
+            self.assertEqual(self.recorder.lines, ['12:34 Traceback (most recent call last):\n  File "app.py", line 1\nValueError'])
+
+        # The last record is only complete after the timeout
+        self.watcher.flush_records()
+        self.assertEqual(len(self.recorder.lines), 1)
+        self.watcher.flush_records(now=time.time() + 2)
+        self.assertEqual(self.recorder.lines[1:], ['12:35 Started'])
+        self.assertIsNone(self.watcher.time_until_next_flush())
+
+    def test_records_after_reload(self):
+        syslog = join(self.folder, 'syslog')
+        self.watcher.set_assembler(syslog, RecordAssembler(r'\d\d:\d\d '))
+        self.watcher.add_handler(syslog, self.recorder)
+
+        with open(syslog, 'w') as handle:
+            handle.write('12:34 First\n  continued\n')
+            handle.flush()
+            self.poll()
+
+            new_recorder = RecordingAbstractLineHandler()
+            self.watcher.reload_handlers([(syslog, new_recorder)])
+
+            handle.write('  and continued\n12:35 Second\n')
+            handle.flush()
+            self.poll()
+
+        self.assertEqual(new_recorder.lines, ['12:34 First\n  continued\n  and continued'])
+
+    def test_records_after_rotation(self):
+        syslog = join(self.folder, 'syslog')
+        self.watcher.set_assembler(syslog, RecordAssembler(r'\d\d:\d\d '))
+        self.watcher.add_handler(syslog, self.recorder)
+
+        with open(syslog, 'w') as handle:
+            handle.write('12:34 First\n  continued\n')
+            handle.flush()
+            self.poll()
+
+        shutil.move(syslog, syslog + '.1')
+        self.poll()
+
+        with open(syslog, 'w') as handle:
+            handle.write('  without start\n12:35 Second\n')
+            handle.flush()
+            self.poll()
+
+        self.assertEqual(self.recorder.lines, ['12:34 First\n  continued', '  without start'])
+
+    def test_records_after_truncation(self):
+        syslog = join(self.folder, 'syslog')
+        self.watcher.set_assembler(syslog, RecordAssembler(r'\d\d:\d\d '))
+        self.watcher.add_handler(syslog, self.recorder)
+
+        with open(syslog, 'w') as handle:
+            handle.write('12:34 First\n  continued\n')
+            handle.flush()
+            self.poll()
+
+            handle.seek(0)
+            handle.truncate()
+            handle.write('  x\n')
+            handle.flush()
+            self.poll()
+
+        self.assertEqual(self.recorder.lines, ['12:34 First\n  continued'])
+        self.assertEqual(self.watcher.assemblers[syslog].pending, ['  x'])
+
+    def test_records_after_expiry(self):
+        syslog = join(self.folder, 'syslog')
+        self.watcher.set_assembler(syslog, RecordAssembler(r'\d\d:\d\d '))
+        self.watcher.add_handler(syslog, self.recorder)
+
+        with open(syslog, 'w') as handle:
+            handle.write('12:34 First\n  continued\n')
+            handle.flush()
+            self.poll()
+
+        os.unlink(syslog)
+        self.poll()
+        self.watcher.expire_files(0, now=time.time() + 1)
+
+        self.assertEqual(self.recorder.lines, ['12:34 First\n  continued'])
+        self.assertIsNone(self.watcher.time_until_next_flush())
+
+    def test_reload_removes_directory_watch(self):
+        subfolder = join(self.folder, 'sub')
+        os.mkdir(subfolder)
+        syslog = join(subfolder, 'syslog')
+        self.watcher.add_handler(syslog, self.recorder)
+
+        self.watcher.reload_handlers([])
+        self.poll()
+
+        self.assertEqual(self.watcher.filestats, {})
+        self.assertEqual(self.watcher.dirstats, {})
+        self.assertIsNone(self.watcher.path(subfolder))
+
+    def test_rotation_keeps_dirstats_small(self):
+        syslog = join(self.folder, 'syslog')
+        self.watcher.add_handler(syslog, self.recorder)
+
+        for index in range(3):
+            with open(syslog, 'w') as handle:
+                handle.write('12:34 Entry {}\n'.format(index))
+            self.poll()
+            shutil.move(syslog, syslog + '.1')
+            self.poll()
+
+        self.assertEqual(self.watcher.dirstats[self.folder].filenames, set([syslog]))
+
+    def test_add_handlers(self):
+        os.mkdir(join(self.folder, 'app'))
+        syslog = join(self.folder, 'syslog')
+        messages = join(self.folder, 'messages')
+        app = join(self.folder, 'app', 'app.log')
+        for path in (syslog, app):
+            with open(path, 'w') as handle:
+                handle.write('12:34 Existing entry\n')
+        other = RecordingAbstractLineHandler()
+
+        self.watcher.add_handlers([(syslog, self.recorder), (messages, self.recorder), (app, self.recorder), (syslog, other)])
+
+        self.assertEqual(self.watcher.filestats[syslog].handlers, [self.recorder, other])
+        self.assertEqual(self.watcher.dirstats[self.folder].filenames, set([syslog, messages]))
+        self.assertEqual(self.watcher.dirstats[join(self.folder, 'app')].filenames, set([app]))
+        self.assertIsNone(self.watcher.filestats[messages].filehandle)
+
+        for path in (syslog, messages, app):
+            with open(path, 'a') as handle:
+                handle.write('12:35 New entry in {}\n'.format(os.path.basename(path)))
+        self.poll()
+
+        self.assertEqual(sorted(self.recorder.lines), [
+            '12:35 New entry in app.log',
+            '12:35 New entry in messages',
+            '12:35 New entry in syslog',
+        ])
+        self.assertEqual(other.lines, ['12:35 New entry in syslog'])
+
+    def test_add_handlers_to_known_directory(self):
+        syslog = join(self.folder, 'syslog')
+        messages = join(self.folder, 'messages')
+        self.watcher.add_handler(syslog, self.recorder)
+        self.watcher.add_handlers([(syslog, self.recorder), (messages, self.recorder)], threads=1)
+        self.assertEqual(self.watcher.dirstats[self.folder].filenames, set([syslog, messages]))
+
+    def test_expire_files(self):
+        syslog = join(self.folder, 'syslog')
+        messages = join(self.folder, 'messages')
+        with open(messages, 'w') as handle:
+            handle.write('12:34 First entry\n')
+        self.watcher.add_handler(syslog, self.recorder)
+        self.watcher.add_handler(messages, self.recorder)
+
+        self.watcher.expire_files(60, now=time.time() + 30)
+        self.assertEqual(sorted(self.watcher.filestats), [messages, syslog])
+
+        self.watcher.expire_files(60, now=time.time() + 90)
+        self.assertEqual(list(self.watcher.filestats), [messages])
+        self.assertEqual(self.watcher.dirstats[self.folder].filenames, set([messages]))
+
+        os.unlink(messages)
+        self.poll()
+        self.watcher.expire_files(60, now=time.time() + 90)
+        self.assertEqual(self.watcher.filestats, {})
+        self.assertEqual(self.watcher.dirstats, {})
+
+    def drop_events(self):
+        '''Read the pending events without processing them, like an overflowing kernel would'''
+        while self.poller.poll(self.POLL_TIMEOUT):
+            self.watcher.read()
+
+    def test_queue_overflow(self):
+        syslog = join(self.folder, 'syslog')
+        messages = join(self.folder, 'messages')
+        authlog = join(self.folder, 'auth.log')
+        messages_recorder = RecordingAbstractLineHandler()
+        authlog_recorder = RecordingAbstractLineHandler()
+        with open(syslog, 'w') as handle:
+            handle.write('12:34 First entry\n')
+        with open(messages, 'w') as handle:
+            handle.write('12:34 First entry\n12:35 Second entry\n')
+        self.watcher.add_handler(syslog, self.recorder)
+        self.watcher.add_handler(messages, messages_recorder)
+        self.watcher.add_handler(authlog, authlog_recorder)
+
+        with open(syslog, 'a') as handle:
+            handle.write('12:35 Second entry\n')
+        shutil.move(syslog, syslog + '.1')
+        with open(syslog, 'w') as handle:
+            handle.write('12:36 Third entry\n')
+        with open(messages, 'w') as handle:
+            handle.write('12:36 Truncated\n')
+        with open(authlog, 'w') as handle:
+            handle.write('12:36 Created\n')
+
+        self.drop_events()
+        overflows = MyWatcher.overflowcount._value
+        self.watcher.process_q_overflow(None)
+        self.assertEqual(MyWatcher.overflowcount._value, overflows + 1)
+
+        self.assertEqual(self.recorder.lines, ['12:35 Second entry', '12:36 Third entry'])
+        self.assertEqual(messages_recorder.lines, ['12:36 Truncated'])
+        self.assertEqual(authlog_recorder.lines, ['12:36 Created'])
+
+        # Back to normal operation
+        with open(syslog, 'a') as handle:
+            handle.write('12:37 Fourth entry\n')
+        with open(syslog + '.1', 'a') as handle:
+            handle.write('12:37 Rotated entry\n')
+        self.poll()
+
+        self.assertEqual(self.recorder.lines, ['12:35 Second entry', '12:36 Third entry', '12:37 Fourth entry'])
+
+    def test_queue_overflow_removed_file(self):
+        syslog = join(self.folder, 'syslog')
+        with open(syslog, 'w') as handle:
+            handle.write('12:34 First entry\n')
+        self.watcher.add_handler(syslog, self.recorder)
+
+        with open(syslog, 'a') as handle:
+            handle.write('12:35 Second entry\n')
+        os.unlink(syslog)
+
+        self.drop_events()
+        self.watcher.process_q_overflow(None)
+        self.poll()
+
+        self.assertEqual(self.recorder.lines, ['12:35 Second entry'])
+        self.assertIsNone(self.watcher.filestats[syslog].filehandle)
+
+        with open(syslog, 'w') as handle:
+            handle.write('12:36 Third entry\n')
+        self.poll()
+
+        self.assertEqual(self.recorder.lines, ['12:35 Second entry', '12:36 Third entry'])
+
+
+class TestDispatchTable(unittest.TestCase):
+
+    def test_dispatch_table(self):
+        table = dict(MyWatcher.dispatch_table())
+        self.assertEqual(table[inotify.IN_MODIFY], MyWatcher.process_modify)
+        self.assertEqual(table[inotify.IN_Q_OVERFLOW], MyWatcher.process_q_overflow)
+        self.assertNotIn(inotify.IN_ACCESS, table)
+        self.assertIs(MyWatcher.dispatch_table(), MyWatcher.dispatch_table())
+
+    def test_dispatch_table_per_class(self):
+        class AccessWatcher(MyWatcher):
+            def process_access(self, event):
+                pass
+
+        self.assertIn(inotify.IN_ACCESS, dict(AccessWatcher.dispatch_table()))
+        self.assertNotIn(inotify.IN_ACCESS, dict(MyWatcher.dispatch_table()))
+
+
+class TestSampling(unittest.TestCase):
+
+    def setUp(self):
+        self.handler = RecordingAbstractLineHandler()
+
+    def test_no_sampling(self):
+        lines = ['a', 'b', 'c']
+        self.assertEqual(self.handler.sample(lines), lines)
+        self.assertEqual(self.handler.sample_weight, 1)
+
+    def test_sampling_is_independent_of_batches(self):
+        self.handler.sample_every = 4
+        lines = [str(index) for index in range(20)]
+
+        sampled = []
+        for (start, end) in [(0, 3), (3, 4), (4, 9), (9, 9), (9, 20)]:
+            sampled.extend(self.handler.sample(lines[start:end]))
+
+        self.assertEqual(sampled, ['0', '4', '8', '12', '16'])
+        self.assertEqual(self.handler.sample_weight, 4)
+
+
+class CountingLineHandler(AbstractLineHandler):
+
+    '''LineHandler with testcases that keeps track of its instantiations'''
+
+    counter = prometheus_client.Counter('counting_lines', 'Test', ['filename'], registry=None)
+    instances = 0
+
+    testcases = [
+        {
+            'input': '''One
+Two''',
+            'expected': [
+                ('counting_lines', [('filename', 'test')], 2.0),
+            ]
+        }
+    ]
+
+    def __init__(self):
+        super(CountingLineHandler, self).__init__()
+        CountingLineHandler.instances += 1
+
+    def process(self, line):
+        self.counter.labels('test').inc()
+
+
+module_counter = prometheus_client.Counter('module_counting_lines', 'Test', ['filename'], registry=None)
+
+
+class ModuleCountingLineHandler(AbstractLineHandler):
+
+    '''LineHandler with testcases that uses a module level metric'''
+
+    testcases = [
+        {
+            'input': '''One
+Two''',
+            'expected': [
+                ('module_counting_lines', [('filename', 'test')], 2.0),
+            ]
+        }
+    ]
+
+    def process(self, line):
+        module_counter.labels('test').inc()
+
+
+class TestRunTestcases(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.cache_path = join(self.folder, 'cache', 'testcases.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_metrics_are_left_alone(self):
+        CountingLineHandler.counter.labels('live').inc(5)
+        self.assertEqual(run_testcases([CountingLineHandler()], jobs=1), (0, 0))
+        self.assertEqual(CountingLineHandler.counter.labels('live')._value, 5)
+        self.assertNotIn(('test',), CountingLineHandler.counter._metrics)
+
+    def test_metrics_are_left_alone_during_testcases(self):
+        seen = []
+        served = CountingLineHandler.counter
+        served.labels('live').inc(5)
+
+        class PeekingLineHandler(CountingLineHandler):
+            def process(self, line):
+                seen.append(served.labels('live')._value)
+                super(PeekingLineHandler, self).process(line)
+
+        self.assertEqual(run_testcases([PeekingLineHandler()], jobs=1), (0, 0))
+        self.assertEqual(seen, [served.labels('live')._value] * 2)
+
+    def test_module_and_class_level_metrics(self):
+        class ClassNameLineHandler(CountingLineHandler):
+            def process(self, line):
+                CountingLineHandler.counter.labels('test').inc()
+
+        module_counter.labels('live').inc(5)
+        self.assertEqual(run_testcases([ModuleCountingLineHandler(), ClassNameLineHandler()], jobs=1), (0, 0))
+        self.assertEqual(module_counter.labels('live')._value, 5)
+        self.assertNotIn(('test',), module_counter._metrics)
+        self.assertNotIn(('test',), CountingLineHandler.counter._metrics)
+        self.assertIs(ClassNameLineHandler.counter, CountingLineHandler.counter)
+
+    def test_served_metrics_changed(self):
+        served = prometheus_client.Counter('served_counting_lines', 'Test', ['filename'])
+        try:
+            class HiddenCounterLineHandler(CountingLineHandler):
+                def process(self, line):
+                    super(HiddenCounterLineHandler, self).process(line)
+                    served.labels('test').inc()
+
+            self.assertEqual(run_testcases([HiddenCounterLineHandler()], jobs=1), (0, 1))
+        finally:
+            prometheus_client.REGISTRY.unregister(served)
+
+    def test_no_forking_with_threads(self):
+        stop = threading.Event()
+        thread = threading.Thread(target=stop.wait)
+        thread.start()
+        pool = logfile_exporter.multiprocessing.Pool
+        logfile_exporter.multiprocessing.Pool = None  # Fails when used
+        try:
+            class OtherCountingLineHandler(CountingLineHandler):
+                pass
+            self.assertEqual(run_testcases([CountingLineHandler(), OtherCountingLineHandler()], jobs=2), (0, 0))
+        finally:
+            logfile_exporter.multiprocessing.Pool = pool
+            stop.set()
+            thread.join()
+
+    def test_failures_in_parallel(self):
+        class FailingLineHandler(CountingLineHandler):
+            testcases = [{'input': 'One', 'expected': []}]
+
+        self.assertEqual(run_testcases([CountingLineHandler(), FailingLineHandler()], jobs=2), (1, 0))
+
+    def test_cache(self):
+        handler = CountingLineHandler()
+        instances = CountingLineHandler.instances
+
+        self.assertEqual(run_testcases([handler], cache_path=self.cache_path, jobs=1), (0, 0))
+        self.assertEqual(CountingLineHandler.instances, instances + 1)
+
+        self.assertEqual(run_testcases([handler], cache_path=self.cache_path, jobs=1), (0, 0))
+        self.assertEqual(CountingLineHandler.instances, instances + 1)
+
+    def test_failures_are_not_cached(self):
+        class FailingLineHandler(CountingLineHandler):
+            testcases = [{'input': 'One', 'expected': []}]
+
+        self.assertEqual(run_testcases([FailingLineHandler()], cache_path=self.cache_path, jobs=1), (1, 0))
+        self.assertEqual(run_testcases([FailingLineHandler()], cache_path=self.cache_path, jobs=1), (1, 0))
+
+
+class OfflineCountingLineHandler(AbstractLineHandler):
+
+    testcases = False
+    order_independent = True
+    counter = prometheus_client.Counter('offline_lines', 'Test', ['first_letter'], registry=None)
+
+    def process(self, line):
+        self.counter.labels(line[:1]).inc()
+
+
+class OfflineHistogramLineHandler(AbstractHistogramLineHandler):
+
+    testcases = False
+    order_independent = True
+    histogram = prometheus_client.Histogram('offline_lengths', 'Test', ['filename'], registry=None, buckets=(5, 10))
+
+    def extract(self, line):
+        return len(line)
+
+
+class OfflineTimestampLineHandler(AbstractLineHandler):
+
+    testcases = False
+    order_independent = True
+    counter = prometheus_client.Counter('offline_events', 'Test', ['filename'], registry=None)
+
+    def process(self, line):
+        counter = self.counter.labels('syslog')
+        counter.inc()
+        annotate(counter, timestamp=self.parse_timestamp(line))
+
+
+class TestOffline(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.syslog = join(self.folder, 'syslog')
+        self.handlers = [OfflineCountingLineHandler(), OfflineHistogramLineHandler('syslog')]
+        self.metric_values = [swap_metric_values(handler_metric) for handler_metric in (OfflineCountingLineHandler.counter, OfflineHistogramLineHandler.histogram)]
+
+        self._chunk_size = logfile_exporter.OFFLINE_CHUNK_SIZE
+        self._min_range_size = logfile_exporter.OFFLINE_MIN_RANGE_SIZE
+        logfile_exporter.OFFLINE_CHUNK_SIZE = 7
+        logfile_exporter.OFFLINE_MIN_RANGE_SIZE = 10
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+        for (handler_metric, values) in zip((OfflineCountingLineHandler.counter, OfflineHistogramLineHandler.histogram), self.metric_values):
+            swap_metric_values(handler_metric, values)
+        logfile_exporter.OFFLINE_CHUNK_SIZE = self._chunk_size
+        logfile_exporter.OFFLINE_MIN_RANGE_SIZE = self._min_range_size
+
+    def write(self, content):
+        with open(self.syslog, 'wb') as handle:
+            handle.write(content)
+
+    def test_split_file(self):
+        self.write(b'First entry\nSecond\n\nThird entry\nFourth entry\n')
+        byte_ranges = split_file(self.syslog, 4)
+
+        self.assertEqual(byte_ranges[0][0], 0)
+        self.assertEqual(byte_ranges[-1][1], os.path.getsize(self.syslog))
+        lines = []
+        for (start, end) in byte_ranges:
+            with open(self.syslog, 'rb') as handle:
+                handle.seek(start)
+                chunk = handle.read(end - start)
+            self.assertTrue(chunk.endswith(b'\n'))
+            lines.extend(chunk.splitlines())
+        self.assertEqual(lines, [b'First entry', b'Second', b'', b'Third entry', b'Fourth entry'])
+
+    def test_read_lines(self):
+        self.write(u'First entry\nS\xe9cond entry\nThird'.encode('UTF-8'))
+        lines = []
+        for batch in read_lines(self.syslog):
+            lines.extend(batch)
+        self.assertEqual(lines, [u'First entry', u'S\xe9cond entry', u'Third'])
+
+    def run_offline(self, jobs):
+        run_offline(argparse.Namespace(offline_jobs=jobs), [(self.syslog, handler) for handler in self.handlers])
+        return (
+            prometheus_client.generate_latest(OfflineCountingLineHandler.counter),
+            prometheus_client.generate_latest(OfflineHistogramLineHandler.histogram),
+        )
+
+    def test_parallel(self):
+        self.write(''.join('{} entry {}\n'.format('abc'[index % 3], 'x' * (index % 13)) for index in range(500)))
+
+        sequential = self.run_offline(1)
+        swap_metric_values(OfflineCountingLineHandler.counter)
+        swap_metric_values(OfflineHistogramLineHandler.histogram)
+        parallel = self.run_offline(4)
+
+        self.assertIn('offline_lines{first_letter="a"} 167.0', sequential[0])
+        self.assertEqual(parallel, sequential)
+
+    def test_timestamps(self):
+        self.write(''.join('2017-07-14T02:40:{:02}Z entry\n'.format(index) for index in range(60)))
+        for jobs in (1, 4):
+            swap_metric_values(OfflineTimestampLineHandler.counter)
+            run_offline(argparse.Namespace(offline_jobs=jobs), [(self.syslog, OfflineTimestampLineHandler())])
+
+            registry = prometheus_client.CollectorRegistry()
+            registry.register(OfflineTimestampLineHandler.counter)
+            self.assertIn('offline_events_total{filename="syslog"} 60.0 1500000059.0\n', generate_exposition('openmetrics', registry))
+            self.assertIn('offline_events{filename="syslog"} 60.0\n', generate_exposition('prometheus', registry))
+
+    def test_missing_file(self):
+        self.run_offline(4)
+        self.assertEqual(OfflineCountingLineHandler.counter._metrics, {})
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+
+class RecordingPushgatewayHandler(BaseHTTPRequestHandler):
+
+    '''Stand-in for a Pushgateway that records all requests'''
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.requests.append((self.path, self.client_address, body))
+        self.send_response(self.server.status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class TestMetricsPusher(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), RecordingPushgatewayHandler)
+        self.server.requests = []
+        self.server.status = 202
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        self.registry = prometheus_client.CollectorRegistry()
+        self.lines = prometheus_client.Counter('pushed_lines', 'Test', ['filename'], registry=self.registry)
+        self.letters = prometheus_client.Counter('pushed_letters', 'Test', registry=self.registry)
+        self.pusher = MetricsPusher(
+            'http://127.0.0.1:{}/metrics/job/test'.format(self.server.server_port),
+            registry=self.registry,
+            min_backoff=0,
+            max_queue=2,
+        )
+
+    def tearDown(self):
+        if self.pusher.connection is not None:
+            self.pusher.connection.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_only_changed_families(self):
+        self.lines.labels('syslog').inc()
+        self.assertTrue(self.pusher.push())
+        self.assertTrue(self.pusher.push())
+        self.lines.labels('auth.log').inc()
+        self.assertTrue(self.pusher.push())
+
+        self.assertEqual(len(self.server.requests), 2)
+        (path, _client_address, body) = self.server.requests[0]
+        self.assertEqual(path, '/metrics/job/test')
+        self.assertIn('pushed_lines{filename="syslog"} 1.0', body)
+        self.assertIn('pushed_letters 0.0', body)
+
+        body = self.server.requests[1][2]
+        self.assertIn('pushed_lines{filename="syslog"} 1.0', body)
+        self.assertIn('pushed_lines{filename="auth.log"} 1.0', body)
+        self.assertNotIn('pushed_letters', body)
+
+    def test_connection_reuse(self):
+        for amount in range(3):
+            self.letters.inc()
+            self.assertTrue(self.pusher.push())
+        self.assertEqual(len(set(client_address for (_path, client_address, _body) in self.server.requests)), 1)
+
+    def test_retry(self):
+        self.server.status = 503
+        failures = MetricsPusher.pushfailures._value
+        for amount in range(4):
+            self.letters.inc()
+            self.lines.labels('syslog').inc()
+            self.assertFalse(self.pusher.push())
+
+        self.assertEqual(MetricsPusher.pushfailures._value, failures + 4)
+        self.assertEqual(len(self.pusher.queue), 2)
+
+        self.server.status = 202
+        del self.server.requests[:]
+        self.assertTrue(self.pusher.push())
+        self.assertTrue(self.pusher.flush())
+
+        bodies = [body for (_path, _client_address, body) in self.server.requests]
+        self.assertEqual(len(bodies), 2)
+        self.assertIn('pushed_letters 4.0', bodies[-1])
+        self.assertIn('pushed_lines{filename="syslog"} 4.0', bodies[-1])
+
+    def test_backoff(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.pusher.min_backoff = 1
+        self.pusher.max_backoff = 4
+
+        for backoff in [1, 2, 4, 4]:
+            self.assertFalse(self.pusher.push())
+            self.assertEqual(self.pusher.backoff, backoff)
+            self.assertAlmostEqual(self.pusher.time_until_next_push(), backoff, delta=0.5)
+
+    def test_openmetrics(self):
+        self.pusher.push_format = 'openmetrics'
+        lines = self.lines.labels('syslog')
+        lines.inc()
+        annotate(lines, timestamp=1500000000)
+        self.assertTrue(self.pusher.push())
+
+        body = self.server.requests[0][2]
+        self.assertIn('pushed_lines_total{filename="syslog"} 1.0 1500000000.0\n', body)
+        self.assertTrue(body.endswith('# EOF\n'))
+        self.assertEqual(body.count('# EOF'), 1)
+
+    def test_background(self):
+        self.pusher.start()
+        self.letters.inc()
+        self.pusher.next_push = 0
+        self.pusher.tick()
+        self.pusher.stop()
+
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertIn('pushed_letters 1.0', self.server.requests[0][2])
+        self.assertIsNone(self.pusher.thread)
+
+    def test_hanging_pushgateway(self):
+        self.server.release = threading.Event()
+        self.server.RequestHandlerClass = HangingPushgatewayHandler
+        self.pusher.timeout = 5
+        self.pusher.start()
+        try:
+            for _amount in range(3):
+                self.letters.inc()
+                self.pusher.next_push = 0
+                start = time.time()
+                self.pusher.tick()
+                self.assertLess(time.time() - start, 0.5)
+                time.sleep(0.05)
+            # The first batch is being sent, the others wait
+            self.assertEqual(len(self.pusher.queue), 2)
+            self.assertEqual(self.server.requests, [])
+        finally:
+            self.server.release.set()
+            self.pusher.stop()
+
+        self.assertIn('pushed_letters 3.0', self.server.requests[-1][2])
+
+
+class HangingPushgatewayHandler(RecordingPushgatewayHandler):
+
+    '''Stand-in for a Pushgateway that doesn't answer until released'''
+
+    def do_POST(self):
+        self.server.release.wait()
+        RecordingPushgatewayHandler.do_POST(self)
+
+
+class TestOpenMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = prometheus_client.CollectorRegistry()
+
+    def test_counter(self):
+        counter = prometheus_client.Counter('lines', 'Nr. of lines', ['filename'], registry=self.registry)
+        counter.labels('syslog').inc(2)
+        annotate(counter.labels('syslog'), timestamp=1500000002.5)
+        annotate(counter.labels('syslog'), timestamp=1500000001, exemplar={'request_id': 'abc'})
+        counter.labels('auth.log').inc()
+
+        lines = generate_openmetrics(self.registry).splitlines()
+        self.assertEqual(lines[:2], ['# TYPE lines counter', '# HELP lines Nr. of lines'])
+        self.assertEqual(sorted(lines[2:-1]), [
+            'lines_total{filename="auth.log"} 1.0',
+            'lines_total{filename="syslog"} 2.0 1500000002.5 # {request_id="abc"} 1.0 1500000001.0',
+        ])
+        self.assertEqual(lines[-1], '# EOF')
+
+    def test_unlabelled(self):
+        counter = prometheus_client.Counter('requests_total', 'Nr. of requests', registry=self.registry)
+        gauge = prometheus_client.Gauge('lag', 'Lag', registry=self.registry)
+        counter.inc()
+        annotate(counter, exemplar={'request_id': 42})
+        annotate(gauge, timestamp=1500000000)
+
+        output = generate_openmetrics(self.registry)
+        self.assertIn('# TYPE requests counter\nrequests_total 1.0 # {request_id="42"} 1.0\n', output.replace('# HELP requests Nr. of requests\n', ''))
+        self.assertIn('\nlag 0.0 1500000000.0\n', output)
+
+    def test_histogram(self):
+        histogram = prometheus_client.Histogram('seconds', 'Duration', registry=self.registry, buckets=(0.1, 1))
+        histogram.observe(0.5)
+        annotate(histogram, exemplar={'request_id': 'slow'}, value=0.5, timestamp=1500000000)
+
+        lines = generate_openmetrics(self.registry).splitlines()
+        self.assertIn('seconds_bucket{le="0.1"} 0.0 1500000000.0', lines)
+        self.assertIn('seconds_bucket{le="1.0"} 1.0 1500000000.0 # {request_id="slow"} 0.5 1500000000.0', lines)
+        self.assertIn('seconds_bucket{le="+Inf"} 1.0 1500000000.0', lines)
+        self.assertIn('seconds_count 1.0 1500000000.0', lines)
+
+    def test_preferred_format(self):
+        for (accept, expected) in [
+            ('', 'prometheus'),
+            ('text/plain', 'prometheus'),
+            ('application/openmetrics-text;version=1.0.0,application/openmetrics-text;version=0.0.1;q=0.75,text/plain;version=0.0.4;q=0.5,*/*;q=0.1', 'openmetrics'),
+            ('application/openmetrics-text;q=0', 'prometheus'),
+            ('application/openmetrics-text;q=0, text/plain', 'prometheus'),
+            ('application/openmetrics-text; q=0.4, text/plain; q=0.5', 'prometheus'),
+            ('text/plain;q=0.5, APPLICATION/OpenMetrics-Text', 'openmetrics'),
+            ('application/openmetrics-text;q=nonsense', 'prometheus'),
+        ]:
+            self.assertEqual(preferred_format(accept), expected, accept)
+
+    def test_content_negotiation(self):
+        server = MoreRobustHTTPServer(('127.0.0.1', 0), MoreSilentMetricsHandler)
+        url = 'http://127.0.0.1:{}/metrics'.format(server.server_port)
+        openmetrics = 'application/openmetrics-text; version=1.0.0,text/plain;version=0.0.4;q=0.5'
+        try:
+            for (enabled, accept, content_type) in [
+                (False, openmetrics, prometheus_client.CONTENT_TYPE_LATEST),
+                (True, None, prometheus_client.CONTENT_TYPE_LATEST),
+                (True, 'application/openmetrics-text;q=0', prometheus_client.CONTENT_TYPE_LATEST),
+                (True, openmetrics, 'application/openmetrics-text; version=1.0.0; charset=utf-8'),
+            ]:
+                server.openmetrics = enabled
+                request = urllib2.Request(url)
+                if accept:
+                    request.add_header('Accept', accept)
+                thread = threading.Thread(target=server.handle_request)
+                thread.start()
+                response = urllib2.urlopen(request)
+                self.assertEqual(response.info()['Content-Type'], content_type)
+                response.read()
+                thread.join()
+        finally:
+            server.server_close()
+
+
+class TestDebugEndpoints(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.watcher = MyWatcher()
+        self.server = DebugHTTPServer(('127.0.0.1', 0), MoreSilentMetricsHandler, self.watcher)
+        self.thread = threading.Thread(target=self.server.serve_forever, kwargs={'poll_interval': 0.01})
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+        shutil.rmtree(self.folder)
+
+    def get(self, path):
+        return urllib2.urlopen('http://127.0.0.1:{}{}'.format(self.server.server_port, path))
+
+    def test_state(self):
+        syslog = join(self.folder, 'syslog')
+        recorder = RecordingAbstractLineHandler()
+        with open(syslog, 'w') as handle:
+            handle.write('12:34 First entry\n')
+        self.watcher.add_handler(syslog, recorder)
+        with open(syslog, 'a') as handle:
+            handle.write('12:35 Second entry\n12:36 Partial')
+        self.watcher.read_new_lines(syslog)
+
+        response = self.get('/debug/state')
+        self.assertEqual(response.info()['Content-Type'], 'application/json')
+        state = json.load(response)['files'][syslog]
+        self.assertEqual(state['size'], 50)
+        self.assertEqual(state['position'], 50)
+        self.assertEqual(state['unprocessed'], len('12:36 Partial'))
+        self.assertEqual(len(state['handlers']), 1)
+        self.assertEqual(state['handlers'][0]['handler'], '{}.RecordingAbstractLineHandler'.format(RecordingAbstractLineHandler.__module__))
+        self.assertEqual(state['handlers'][0]['batches'], 1)
+        self.assertEqual(state['handlers'][0]['lines'], 1)
+
+    def test_profile(self):
+        stop = threading.Event()
+
+        def busy_ingesting():
+            while not stop.is_set():
+                sum(range(1000))
+
+        ingest = threading.Thread(target=busy_ingesting)
+        ingest.start()
+        try:
+            self.server.ingest_thread = ingest.ident
+            response = self.get('/debug/profile?seconds=0.2')
+            stacks = response.read().splitlines()
+        finally:
+            stop.set()
+            ingest.join()
+
+        self.assertTrue(stacks)
+        (stack, count) = stacks[0].rsplit(' ', 1)
+        self.assertIn('busy_ingesting (tests.py:', stack.split(';')[-1])
+        self.assertGreater(int(count), 0)
+
+    def test_errors(self):
+        for (path, code) in [('/debug/profile?seconds=soon', 400), ('/debug/unknown', 404)]:
+            with self.assertRaises(urllib2.HTTPError) as context:
+                self.get(path)
+            self.assertEqual(context.exception.code, code)
+
+    def test_metrics_still_served(self):
+        self.assertIn('inotify_overflows', self.get('/metrics').read())
+
+
+class TestRecordAssembler(unittest.TestCase):
+
+    def setUp(self):
+        self.assembler = RecordAssembler(r'\d\d:\d\d ', timeout=5, max_size=40)
+
+    def test_records(self):
+        self.assertEqual(self.assembler.add(['  without start', '12:34 First', '  continued'], now=100), ['  without start'])
+        self.assertEqual(self.assembler.add(['  continued again', '12:35 Second'], now=101), ['12:34 First\n  continued\n  continued again'])
+        self.assertEqual(self.assembler.pending, ['12:35 Second'])
+
+    def test_timeout(self):
+        self.assertIsNone(self.assembler.time_until_flush(now=100))
+        self.assertEqual(self.assembler.flush(now=100), [])
+
+        self.assembler.add(['12:34 First'], now=100)
+        self.assembler.add([], now=103)
+        self.assertEqual(self.assembler.time_until_flush(now=103), 2)
+        self.assertEqual(self.assembler.flush(now=103), [])
+        self.assertEqual(self.assembler.flush(now=105), ['12:34 First'])
+        self.assertEqual(self.assembler.flush(now=200), [])
+
+    def test_force(self):
+        self.assembler.add(['12:34 First'], now=100)
+        self.assertEqual(self.assembler.flush(now=100, force=True), ['12:34 First'])
+
+    def test_max_size(self):
+        records = self.assembler.add(['12:34 First', '  ' + 'x' * 20, '  ' + 'y' * 20, '  ' + 'z' * 10], now=100)
+        self.assertEqual(records, ['12:34 First\n  ' + 'x' * 20 + '\n  ' + 'y' * 20])
+        self.assertEqual(self.assembler.pending, ['  ' + 'z' * 10])
+        self.assertEqual(self.assembler.pending_size, 13)
+
+    def test_process_file(self):
+        folder = tempfile.mkdtemp()
+        try:
+            path = join(folder, 'app.log')
+            with open(path, 'w') as handle:
+                handle.write('12:34 First\n  continued\n12:35 Second\n  continued\n')
+            recorder = RecordingAbstractLineHandler()
+            process_file(path, [recorder], assembler=self.assembler)
+            self.assertEqual(recorder.lines, ['12:34 First\n  continued', '12:35 Second\n  continued'])
+        finally:
+            shutil.rmtree(folder)
+
+
+class TestSeriesExpirer(unittest.TestCase):
+
+    def test_sweep(self):
+        registry = prometheus_client.CollectorRegistry()
+        counter = prometheus_client.Counter('lines', 'Test', ['filename'], registry=registry)
+        prometheus_client.Gauge('lag', 'Test', registry=registry)
+        expirer = SeriesExpirer(series_ttl=100, registry=registry)
+
+        counter.labels('syslog').inc()
+        counter.labels('auth.log').inc()
+        expirer.sweep(now=1000)
+        self.assertEqual(SeriesExpirer.activeseries._value, 3)
+
+        counter.labels('syslog').inc()
+        expirer.sweep(now=1050)
+        expirer.sweep(now=1120)
+        self.assertEqual(list(counter._metrics), [(u'syslog',)])
+        self.assertEqual(SeriesExpirer.activeseries._value, 2)
+
+        expirer.sweep(now=1200)
+        self.assertEqual(counter._metrics, {})
+        self.assertEqual(expirer.last_changed, {})
+
+    def test_counts_samples(self):
+        registry = prometheus_client.CollectorRegistry()
+        histogram = prometheus_client.Histogram('seconds', 'Test', ['filename'], registry=registry, buckets=(1, 2))
+        prometheus_client.Histogram('lengths', 'Test', registry=registry, buckets=(1, 2))
+        multiple = prometheus_client.core.Metric('process', 'Test', 'gauge')
+        multiple.add_sample('process_open_fds', {}, 3)
+        multiple.add_sample('process_max_fds', {}, 1024)
+        registry.register(StaticCollector([multiple]))
+        expirer = SeriesExpirer(registry=registry)
+
+        histogram.labels('syslog').observe(1.5)
+        expirer.sweep(now=1000)
+        # 3 buckets, sum and count per histogram and 2 process samples
+        self.assertEqual(SeriesExpirer.activeseries._value, 12)
+
+    def test_cardinality_gauge(self):
+        registry = prometheus_client.CollectorRegistry()
+        counter = prometheus_client.Counter('lines', 'Test', ['filename'], registry=registry)
+
+        class SourcesLineHandler(AbstractCardinalityLineHandler):
+            gauge = prometheus_client.Gauge('sources', 'Test', ['filename'], registry=registry)
+
+            def extract(self, line):
+                return line
+
+        handler = SourcesLineHandler('auth.log')
+        expirer = SeriesExpirer(series_ttl=100, registry=registry)
+
+        for line in ['10.0.0.1', '10.0.0.2']:
+            handler.process(line)
+            counter.labels('auth.log').inc()
+        expirer.sweep(now=1000)
+
+        # Only repeated sources, so the estimate stays the same
+        for now in (1050, 1100, 1150, 1200):
+            handler.process('10.0.0.1')
+            expirer.sweep(now=now)
+
+        self.assertEqual(SourcesLineHandler.gauge.labels('auth.log')._value, 2)
+        self.assertEqual(counter._metrics, {})
+        self.assertEqual(SeriesExpirer.activeseries._value, 1)
+
+    def test_no_series_ttl(self):
+        registry = prometheus_client.CollectorRegistry()
+        counter = prometheus_client.Counter('lines', 'Test', ['filename'], registry=registry)
+        expirer = SeriesExpirer(registry=registry)
+
+        counter.labels('syslog').inc()
+        expirer.sweep(now=1000)
+        expirer.sweep(now=100000)
+        self.assertEqual(list(counter._metrics), [(u'syslog',)])
+
+
+class TestHyperLogLog(unittest.TestCase):
+
+    def test_small_cardinality(self):
+        hyperloglog = HyperLogLog()
+        for item in ['a', 'b', 'c', 'a', u'\xe9', 'b']:
+            hyperloglog.add(item)
+        self.assertEqual(round(hyperloglog.cardinality()), 4)
+
+    def test_large_cardinality(self):
+        hyperloglog = HyperLogLog()
+        for index in range(50000):
+            hyperloglog.add('10.0.{}.{}'.format(index // 256, index % 256))
+        # Standard error is 1.6%; 5% gives plenty of margin
+        self.assertAlmostEqual(hyperloglog.cardinality(), 50000, delta=2500)
+
+    def test_add_reports_changes(self):
+        hyperloglog = HyperLogLog()
+        self.assertTrue(hyperloglog.add('a'))
+        self.assertFalse(hyperloglog.add('a'))
+
+    def test_memory_is_fixed(self):
+        hyperloglog = HyperLogLog(precision=10)
+        for index in range(5000):
+            hyperloglog.add(str(index))
+        self.assertEqual(len(hyperloglog.registers), 1024)
+
+
+class TestSpaceSaving(unittest.TestCase):
+
+    def test_heavy_hitters(self):
+        spacesaving = SpaceSaving(capacity=3)
+        for index in range(1000):
+            spacesaving.add('frequent')
+            if index % 2:
+                spacesaving.add('common')
+            spacesaving.add('rare {}'.format(index))
+
+        self.assertEqual(len(spacesaving.counts), 3)
+        self.assertEqual([item for (item, _count) in spacesaving.top(2)], ['frequent', 'common'])
+
+    def test_eviction(self):
+        spacesaving = SpaceSaving(capacity=2)
+        self.assertIsNone(spacesaving.add('a', 5))
+        self.assertIsNone(spacesaving.add('b'))
+        self.assertEqual(spacesaving.add('c'), 'b')
+        self.assertEqual(spacesaving.counts, {'a': 5, 'c': 2})
+        self.assertEqual(spacesaving.errors, {'a': 0, 'c': 1})
+
+
+class TestObserveMany(unittest.TestCase):
+
+    def test_same_as_observe(self):
+        values = [0.001, 0.01, 0.3, 0.3, 1.0, 2.6, 7.5, 12.0, 0.0]
+        one_by_one = prometheus_client.Histogram('one_by_one', 'Test', registry=None)
+        for value in values:
+            one_by_one.observe(value)
+
+        batched = prometheus_client.Histogram('batched', 'Test', registry=None)
+        observe_many(batched, values[:4])
+        observe_many(batched, values[4:])
+
+        self.assertEqual(batched._buckets, one_by_one._buckets)
+        self.assertAlmostEqual(batched._sum, one_by_one._sum)
+
+    def test_weight(self):
+        histogram = prometheus_client.Histogram('weighted', 'Test', registry=None, buckets=(1, 2))
+        observe_many(histogram, [0.5, 1.5, 1.5], weight=10)
+        self.assertEqual(histogram._buckets, [10.0, 20.0, 0.0])
+        self.assertEqual(histogram._sum, 35.0)
+
+
+class TestTimestampParser(unittest.TestCase):
+
+    def test_iso8601(self):
+        parser = TimestampParser()
+        self.assertEqual(parser.parse('2026-10-18T12:34:56Z started'), 1792326896)
+        self.assertEqual(parser.parse('x 2026-10-18 14:34:56.250+02:00 y'), 1792326896.25)
+        self.assertEqual(parser.parse('2026-10-18T07:34:56,5-0500'), 1792326896.5)
+        self.assertEqual(
+            parser.parse('2026-10-18 12:34:56 local'),
+            time.mktime((2026, 10, 18, 12, 34, 56, 0, 0, -1)))
+
+    def test_common_log_format(self):
+        parser = TimestampParser()
+        line = '127.0.0.1 - - [18/Oct/2026:14:34:56 +0200] "GET / HTTP/1.1" 200 1234'
+        self.assertEqual(parser.parse(line), 1792326896)
+
+    def test_syslog(self):
+        parser = TimestampParser()
+        recently = time.localtime(time.time() - 3600)
+        line = time.strftime('%b %d %H:%M:%S myhost cron[123]: job done', recently)
+        self.assertEqual(parser.parse(line), time.mktime(recently[:8] + (-1,)))
+
+        # A date later this year must be from last year
+        tomorrow = time.localtime(time.time() + 3 * 86400)
+        line = '{} {:2} 00:00:00 myhost kernel: boot'.format(
+            time.strftime('%b', tomorrow), tomorrow.tm_mday)
+        self.assertLess(parser.parse(line), time.time())
+        self.assertGreater(parser.parse(line), time.time() - 366 * 86400)
+        self.assertEqual(parser.parse(line.replace('00:00:00', '00:00:00.5')) % 1, 0.5)
+
+    def test_earliest_timestamp_wins(self):
+        recently = time.localtime(time.time() - 3600)
+        syslog = time.strftime('%b %d %H:%M:%S myhost app: retrying job scheduled for 2020-01-01 00:00:00', recently)
+        access = '127.0.0.1 - - [18/Oct/2026:14:34:56 +0200] "GET /?since=2020-01-01T00:00:00 HTTP/1.1" 200 1234'
+
+        parser = TimestampParser()
+        self.assertEqual(parser.parse(syslog), time.mktime(recently[:8] + (-1,)))
+        self.assertEqual(parser.parse(access), 1792326896)
+
+        # The same after the format order changed
+        for line in ('2026-10-18T12:34:56Z started', syslog, '[18/Oct/2026:14:34:56 +0200] request'):
+            parser = TimestampParser()
+            parser.parse(line)
+            self.assertEqual(parser.parse(syslog), time.mktime(recently[:8] + (-1,)))
+            self.assertEqual(parser.parse(access), 1792326896)
+
+    def test_unknown(self):
+        parser = TimestampParser()
+        self.assertIsNone(parser.parse('no time here'))
+        self.assertIsNone(parser.parse('2026-13-45T12:34:56Z impossible date'))
+        self.assertIsNone(parser.parse('2026-13-45 12:34:56 impossible local date'))
+        self.assertIsNone(parser.parse('2026-10-45 12:34:56 impossible local date'))
+        self.assertIsNone(parser.parse('2026-10-45T12:34:56+0200 impossible date'))
+        self.assertIsNone(parser.parse('[45/Oct/2026:12:34:56 +0000] impossible date'))
+        self.assertIsNone(parser.parse('Feb 30 12:34:56 myhost impossible date'))
+
+    def test_cache(self):
+        parser = TimestampParser()
+        for index in range(100):
+            self.assertEqual(parser.parse('2026-10-18T12:34:56.{:02}Z line'.format(index)), 1792326896 + index / 100.0)
+        self.assertEqual(len(parser.cache), 1)
+
+        parser.max_cache_size = 10
+        for index in range(25):
+            parser.parse('2026-10-18T12:{:02}:00Z line'.format(index))
+        self.assertLessEqual(len(parser.cache), 10)
+
+    def test_last_format_first(self):
+        parser = TimestampParser()
+        parser.parse('[18/Oct/2026:14:34:56 +0200] request')
+        self.assertIs(parser.formats[0], TimestampParser.FORMATS[1])
+
+
+class TestIngestionLag(unittest.TestCase):
+
+    def test_last_timestamp_counts(self):
+        handler = IngestionLagLineHandler('test.log')
+        now = time.time()
+        lines = [
+            time.strftime('%Y-%m-%dT%H:%M:%S+0000 first', time.gmtime(now - 100)),
+            time.strftime('%Y-%m-%dT%H:%M:%S+0000 last', time.gmtime(now - 10)),
+            'continuation without timestamp',
+        ]
+        handler.process_lines(lines)
+        lag = IngestionLagLineHandler.lag.labels('test.log')
+        self.assertGreaterEqual(lag._value, 10)
+        self.assertLess(lag._value, 100)
+        self.assertFalse(hasattr(lag, '_event_timestamp'))
+
+        IngestionLagLineHandler.lag.remove('test.log')
+
 
 if __name__ == '__main__':
     logging.basicConfig(